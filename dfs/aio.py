@@ -0,0 +1,231 @@
+#-*- coding: utf-8 -*-
+
+"""Asynchronous API of the DFS client: the operations return a Future at
+   once, and run in the background, in at most aio_workers threads (see
+   the client config), so one thread can keep many of them in flight.
+
+   The connections are shared with dfs.client (see utils.pool), and the
+   files are dfs.client.File, e.g.:
+       futures = [dfs.aio.open(filepath) for filepath in filepaths]
+       contents = [f.read() for f in dfs.aio.gather(futures)]
+
+       with dfs.aio.open('/data/out', 'w') as f:
+           f.write('...')
+"""
+
+import atexit
+import collections
+import logging
+import sys
+import threading
+
+import client
+
+class Future:
+    """The result of an operation running in the background (see
+       submit).
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        # sys.exc_info() of the exception raised by the operation
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """Return True if the operation is finished."""
+
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the operation (at most timeout seconds, raise a
+           DFSIOError after that) and return its result, or raise its
+           exception.
+        """
+
+        if not self._done.wait(timeout):
+            raise client.DFSIOError('The operation isn\'t finished after'
+                                    ' %s seconds.' % timeout)
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+    def exception(self, timeout=None):
+        """Like result, but return the exception of the operation (None
+           if it succeeded).
+        """
+
+        try:
+            self.result(timeout)
+        except Exception as e:
+            if not self.done():
+                raise
+
+            return e
+
+    def add_done_callback(self, fn):
+        """Call fn(future) when the operation is finished (now if it
+           already is), in the thread which ran it.
+        """
+
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+
+        fn(self)
+
+    def _set(self, result=None, exc_info=None):
+        """Finish the operation and call the callbacks."""
+
+        with self._lock:
+            self._result, self._exc_info = result, exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logging.exception(e)
+
+
+class _OpenFuture(Future):
+    """Future of open, which can be used as a context manager: the File
+       is waited for when the block is entered, and closed when it's left.
+    """
+
+    def __enter__(self):
+        return self.result().__enter__()
+
+    def __exit__(self, exc, value, tb):
+        return self.result().__exit__(exc, value, tb)
+
+
+class _Executor:
+    """Run the operations submitted in at most aio_workers threads,
+       started when they're needed.
+    """
+
+    def __init__(self):
+        # (future, fn, args, kwds) waiting for a thread
+        self.tasks = collections.deque()
+        self.idle = 0
+        self.closed = False
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, future, fn, args, kwds):
+        """Run fn(*args, **kwds) in the background, its result is given to
+           future.
+        """
+
+        with self._cond:
+            self.tasks.append((future, fn, args, kwds))
+
+            # one thread per task, the idle ones take the first tasks
+            if len(self.tasks) > self.idle and\
+                    len(self._threads) < client._config['aio_workers']:
+                thread = threading.Thread(target=self._work_forever)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+            self._cond.notify()
+
+        return future
+
+    def close(self):
+        """Wait for the operations submitted, then stop the threads."""
+
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+
+        for thread in threads:
+            thread.join()
+
+    def _work_forever(self):
+        """Run the tasks, one at a time, until the executor is closed and
+           there is none left.
+        """
+
+        while True:
+            with self._cond:
+                self.idle += 1
+
+                while not self.tasks and not self.closed:
+                    self._cond.wait()
+
+                self.idle -= 1
+
+                if not self.tasks:
+                    return
+
+                future, fn, args, kwds = self.tasks.popleft()
+
+            try:
+                result = fn(*args, **kwds)
+            except Exception:
+                future._set(exc_info=sys.exc_info())
+            else:
+                future._set(result)
+
+
+def submit(fn, *args, **kwds):
+    """Run fn(*args, **kwds) (e.g. a function of dfs.client) in the
+       background, return its Future.
+    """
+
+    return _executor.submit(Future(), fn, args, kwds)
+
+
+def open(filepath, mode='rtc', **kwds):
+    """Open filepath in the background (see dfs.client.File for the
+       arguments), return the Future of the File (which can be used as a
+       context manager, see _OpenFuture).
+    """
+
+    return _executor.submit(_OpenFuture(), client.File,
+                            (filepath, mode), kwds)
+
+
+def aclose(f):
+    """Close the File f (i.e. send it, see dfs.client.File.close) in the
+       background, return the Future of the operation.
+    """
+
+    return submit(f.close)
+
+
+def aunlink(filepath, lock_id=None):
+    """See dfs.client.unlink, return the Future of the operation."""
+
+    return submit(client.unlink, filepath, lock_id)
+
+
+def arename(filepath, newfilepath):
+    """See dfs.client.rename, return the Future of the operation."""
+
+    return submit(client.rename, filepath, newfilepath)
+
+
+def gather(futures, timeout=None):
+    """Wait for all the futures, return the list of their results (or
+       raise the exception of the first one which failed).
+
+       timeout: see Future.result (for each future)
+    """
+
+    return [future.result(timeout) for future in futures]
+
+
+_executor = _Executor()
+# before the files are sent in the background and the locks are revoked
+# by dfs.client (the atexit functions are called in the reverse order)
+atexit.register(_executor.close)
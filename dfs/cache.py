@@ -0,0 +1,222 @@
+#-*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+class Cache:
+    """On-disk cache of the content of remote files, with a LRU eviction.
+
+       Each file is stored in directory under the md5 of its path, next to
+       a .json file holding its path, its version (e.g. its Last-Modified)
+       and its size. The order of the LRU is the mtime of the stored files,
+       so the cache survives to a restart of the client.
+    """
+
+    def __init__(self, directory, max_bytes, max_entries, stale_age=3600):
+        """directory: where the files are stored (created if needed)
+           max_bytes: the maximum total size of the stored files
+           max_entries: the maximum number of stored files
+           stale_age: seconds after which the files left by an unfinished
+                      put are removed (before, another process sharing
+                      the directory may still be writing them)
+        """
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.stale_age = stale_age
+        self._entries = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def version(self, filepath):
+        """Return the version of filepath in the cache, or None."""
+
+        with self._lock:
+            entry = self._load().get(filepath)
+
+        return entry and entry['version']
+
+    def open(self, filepath, version):
+        """Return the stored file (opened for reading) if its version is
+           version, otherwise None.
+        """
+
+        with self._lock:
+            entry = self._load().get(filepath)
+
+            if entry is None or entry['version'] != version:
+                return None
+
+            p = self._path(filepath)
+            f = open(p, 'rb')
+            os.utime(p, None)
+            # most recently used → at the end
+            self._entries[filepath] = self._entries.pop(filepath)
+
+        return f
+
+    def put(self, filepath, version, f):
+        """Store the content of the file-like object f (from its begining,
+           its position is restored after) as the version of filepath.
+
+           Files bigger than max_bytes aren't stored.
+        """
+
+        position = f.tell()
+        f.seek(0, 2)
+        size = f.tell()
+
+        if size > self.max_bytes:
+            self.discard(filepath)
+            f.seek(position)
+            return
+
+        with self._lock:
+            self._load()
+
+        fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                f.seek(0)
+                shutil.copyfileobj(f, out)
+        except:
+            os.unlink(tmp)
+            raise
+        finally:
+            f.seek(position)
+
+        entry = {'filepath': filepath, 'version': version, 'size': size}
+
+        with self._lock:
+            self._remove(filepath)
+            os.rename(tmp, self._path(filepath))
+            _write_json(self._path(filepath) + '.json', entry)
+            self._entries[filepath] = entry
+            self._size += size
+            self._evict()
+
+    def discard(self, filepath):
+        """Remove filepath from the cache (if it's there)."""
+
+        with self._lock:
+            self._load()
+            self._remove(filepath)
+
+    def _path(self, filepath):
+        """Return the local path where filepath is stored."""
+
+        return os.path.join(self.directory, hashlib.md5(filepath).hexdigest())
+
+    def _load(self):
+        """Load the index of the stored files, the first time it's needed,
+           and return it (filepath → entry, in LRU order).
+        """
+
+        if self._entries is not None:
+            return self._entries
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        entries = []
+        names = set(os.listdir(self.directory))
+
+        for name in names:
+            p = os.path.join(self.directory, name)
+
+            if name.startswith('.tmp-'):
+                # the client was killed during a put
+                self._unlink_stale(p)
+                continue
+
+            if not name.endswith('.json'):
+                if name + '.json' not in names:
+                    # killed between the rename of the file and its .json
+                    self._unlink_stale(p)
+
+                continue
+
+            try:
+                with open(p) as f:
+                    entry = json.loads(f.read())
+
+                st = os.stat(p[:-len('.json')])
+
+                if st.st_size != entry['size']:
+                    raise ValueError('Bad size for %s.' % entry['filepath'])
+
+            except (IOError, OSError, ValueError, KeyError) as e:
+                logging.warning('Dropping cache entry %s: %s', name, e)
+                _unlink(p)
+                _unlink(p[:-len('.json')])
+                continue
+
+            entries.append((st.st_mtime, entry))
+
+        entries.sort(key=lambda e: e[0])
+
+        self._entries = collections.OrderedDict(
+                (entry['filepath'], entry) for _, entry in entries)
+        self._size = sum(entry['size'] for entry in self._entries.values())
+        self._evict()
+
+        return self._entries
+
+    def _unlink_stale(self, p):
+        """Remove p if it wasn't modified for stale_age seconds."""
+
+        try:
+            if os.path.getmtime(p) < time.time() - self.stale_age:
+                os.unlink(p)
+        except OSError:
+            pass
+
+    def _remove(self, filepath):
+        """Remove filepath, the lock must be held."""
+
+        entry = self._entries.pop(filepath, None)
+
+        if entry is not None:
+            self._size -= entry['size']
+            _unlink(self._path(filepath) + '.json')
+            _unlink(self._path(filepath))
+
+    def _evict(self):
+        """Remove the least recently used files until the cache fits in
+           its limits, the lock must be held.
+        """
+
+        while self._entries and (self._size > self.max_bytes or
+                                 len(self._entries) > self.max_entries):
+            filepath = next(iter(self._entries))
+            logging.info('Evicting %s from the cache.', filepath)
+            self._remove(filepath)
+
+
+def _write_json(p, data):
+    """Atomically write data in p as JSON."""
+
+    tmp = os.path.join(os.path.dirname(p), '.tmp-' + os.path.basename(p))
+
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(data))
+
+    os.rename(tmp, p)
+
+
+def _unlink(p):
+    """Remove p, if it exists."""
+
+    try:
+        os.unlink(p)
+    except OSError:
+        pass
@@ -1,9 +1,22 @@
 #-*- coding: utf-8 -*-
 
-from contextlib import closing
-from httplib import HTTPConnection
+import atexit
+import collections
+import functools
+import hashlib
+import httplib
+import logging
+import random
+import shutil
+import socket
+import threading
+import time
+import weakref
+
+from contextlib import contextmanager
 from tempfile import SpooledTemporaryFile
 
+import cache
 import utils
 
 class DFSIOError(IOError):
@@ -12,136 +25,1591 @@ class DFSIOError(IOError):
     pass
 
 
+class CacheMiss(DFSIOError):
+    """The file can't be served from the cache (see File.from_cache)."""
+
+    pass
+
+
+def _serialized(method):
+    """Wrap the method of SpooledTemporaryFile so it's called with the
+       spool lock of the File held (see File._snapshot).
+    """
+
+    @functools.wraps(method)
+    def serialized(self, *args):
+        with self._spool_lock:
+            return method(self, *args)
+
+    return serialized
+
+
 class File(SpooledTemporaryFile):
     """Is a distant file, it's stored in memory if it size if less than
        the max_size parameter, otherwise it's stored on the disk.
+
+       The files bigger than chunk_size (if it isn't None) are stored in
+       chunks spread over the fileservers (see NameServer), which are
+       read & written in parallel.
     """
 
-    def __init__(self, filepath, mode='rtc'):
+    # the write-back files are copied by the uploader while they're used
+    # (see _Uploader)
+    read = _serialized(SpooledTemporaryFile.read)
+    readline = _serialized(SpooledTemporaryFile.readline)
+    readlines = _serialized(SpooledTemporaryFile.readlines)
+    write = _serialized(SpooledTemporaryFile.write)
+    writelines = _serialized(SpooledTemporaryFile.writelines)
+    seek = _serialized(SpooledTemporaryFile.seek)
+    tell = _serialized(SpooledTemporaryFile.tell)
+    truncate = _serialized(SpooledTemporaryFile.truncate)
+
+    def __init__(self, filepath, mode='rtc', cached_only=False, wait=0,
+                 lock_id=None):
         """filepath: the path of the distant file
            mode: take the same argument as mode argument of the global
-                 open() + optional flag c (which mean store in cache).
+                 open() + optional flag c (which mean store in cache, and
+                 use the cached content if it's still up to date, in one
+                 conditional request)
+                 + optional flag l (lazy, only for read-only files: the
+                 blocks are downloaded when they are read, see
+                 _RangeReader).
+                 + optional flag d (delayed, write-back for writable
+                 files: flush only queues the file, which is sent in the
+                 background, see sync).
+                 In append mode (a without r nor +) the file isn't
+                 downloaded, only the written data is sent and appended
+                 to the remote file (see FileServer.POST).
+           cached_only: if True, raise CacheMiss instead of downloading
+                        the file when it isn't in the cache at all.
+           wait: seconds to wait for the file to be unlocked, instead of
+                 raising a DFSIOError right away (the lock server wakes us
+                 up as soon as the lock is released).
+           lock_id: a lock already granted on filepath (see transaction),
+                    it's used instead of asking a new one, and it isn't
+                    revoked when the file is closed.
         """
 
+        if 'l' in mode and ('w' in mode or 'a' in mode or '+' in mode):
+            raise ValueError('Lazy files (l) are read-only.')
+
         self.mode = mode
         self.filepath = filepath
+        _get_server(filepath)
+
+        self.last_modified = None
+        # identify the version of the file (see FileServer.GET)
+        self.etag = None
+        self.lock_id = None
+        # revoke the lock when it's released
+        self.owns_lock = lock_id is None
+        # keep the lock idle when it's released, see _LockKeeper
+        self.keep_lock = self.owns_lock and 'c' in mode and\
+                         ('a' in mode or 'w' in mode)
+        # checksums of the version etag of the file (see commit)
+        self.base = None
+        # the chunk map of the file if it's stored in chunks (see
+        # utils.get_chunks)
+        self.chunks = None
+        # the spool only holds the data to append (see _send_append)
+        self.append_only = 'a' in mode and 'r' not in mode and\
+                           '+' not in mode
+        # bytes of the spool already appended to the remote file
+        self.appended = 0
+        self._spool_lock = threading.RLock()
+        # the spool is always read & written: it's filled with the remote
+        # content and sent back by commit() (by chunks when on the disk)
+        SpooledTemporaryFile.__init__(self, _config['max_size'], 'w+b')
+
+        host, port = _lockserver(filepath)
+        shared = 'w' not in mode and 'a' not in mode
+
+        if lock_id is not None:
+            self.lock_id = lock_id
+            _keeper.add(filepath, lock_id, self)
+
+        elif shared and not _config['shared_leases'] and not wait:
+            if utils.is_locked(filepath, host, port):
+                raise DFSIOError('The file %s is locked.' % filepath)
+        else:
+            # automatically gets a lock if we're in write/append mode
+            # (before reading the file, so it can't change meanwhile),
+            # otherwise a shared lease: the file can't be replaced while
+            # we're reading it
+            try:
+                # the lock may have been kept since the last time the file
+                # was written (it's also used to read it), see _LockKeeper
+                lock_id = _keeper.take(filepath, self)
+
+                if lock_id is not None and\
+                        not utils.idle_lock(filepath, host, port, lock_id,
+                                            False):
+                    # another client asked for the file meanwhile
+                    _keeper.release(filepath, lock_id)
+                    lock_id = None
+
+                if lock_id is not None:
+                    self.keep_lock = True
+                else:
+                    lock_id = utils.get_lock(filepath, host, port, shared,
+                                             wait)
+                    _keeper.add(filepath, lock_id, self)
+
+                self.lock_id = lock_id
+            except utils.LockRefused:
+                raise DFSIOError('The file %s is locked.' % filepath)
+
+        if 'w' not in mode and not self.append_only:
+            version = None
+
+            if 'c' in mode:
+                version = File._cache.version(filepath)
+
+            try:
+                if cached_only and version is None:
+                    raise CacheMiss('%s isn\'t in the cache.' % filepath)
+
+                if 'l' in mode:
+                    self._open_lazy(version)
+                else:
+                    self._download(version)
+            except:
+                self._release_lock()
+                raise
+
+            if shared and 'l' not in mode:
+                # the whole content is here, lazy files keep the shared
+                # lease until they're closed
+                self._release_lock()
+
+        if 'a' in mode and not self.append_only:
+            self.base = utils.block_checksums(self, _config['block_size'])
+
+        if 'r' in mode:
+            self.seek(0)
+
+    def _download(self, version):
+        """GET the file in the spool, if version is the version of the file
+           in the cache the GET is conditional and the cached content is
+           used if the fileserver answers '304 Not Modified'.
+        """
+
+        headers = {'If-None-Match': version} if version else {}
+        query = '?lock_id=%s' % self.lock_id if self.lock_id else ''
+
+        with _fileserver('GET', self.filepath, query,
+                         headers=headers) as response:
+            status = response.status
+
+            if status == 200:
+                # by chunks, the file may be big
+                shutil.copyfileobj(response, self, _config['block_size'])
+            else:
+                response.read()
+
+        if status == 204 and self._download_chunks(version):
+            return
+
+        if status not in (200, 204, 304):
+            raise DFSIOError('Error (%d) while opening file.' % status)
+
+        self.etag = response.getheader('ETag')
+        self.last_modified = response.getheader('Last-Modified')
+
+        if status == 304:
+            if not self._open_cached(version):
+                # evicted in the meantime
+                self._download(None)
+
+        elif 'c' in self.mode:
+            if status == 200:
+                File._cache.put(self.filepath, self.etag, self)
+            else:
+                File._cache.discard(self.filepath)
+
+    def _open_lazy(self, version):
+        """Replace the spool by a reader doing ranged requests (or by the
+           cached content if version is still the current one).
+        """
+
+        reader = _RangeReader(self.filepath, version, self.lock_id)
+
+        if reader.missing and self._download_chunks(version):
+            # the files stored in chunks are downloaded entirely
+            return
+
+        if reader.not_modified and self._open_cached(version):
+            self.etag = version
+            return
+
+        if reader.not_modified:
+            reader = _RangeReader(self.filepath, lock_id=self.lock_id)
+
+        self._file = reader
+        self._rolled = True
+        self.etag = reader.etag
+        self.last_modified = reader.last_modified
+
+    def _download_chunks(self, version):
+        """Download the chunks of the file in the spool, in parallel (or
+           use the cached content if version is still the current one),
+           return False if the file isn't stored in chunks.
+        """
+
         host, port = utils.get_host_port(_config['nameserver'])
-        self.srv = utils.get_server(filepath, host, port)
+        chunks = utils.get_chunks(self.filepath, host, port)
 
-        if self.srv is None:
-            raise DFSIOError('Impossible to find a server that serve %s.'
-                    % filepath)
+        if chunks is None:
+            return False
 
+        self.chunks = chunks
+        self.etag = _chunks_etag(chunks)
         self.last_modified = None
-        SpooledTemporaryFile.__init__(self, _config['max_size'], mode.replace('c', ''))
 
-        host, port = utils.get_host_port(_config['lockserver'])
-        if utils.is_locked(filepath, host, port):
-            raise DFSIOError('The file %s is locked.' % filepath)
+        if version == self.etag and self._open_cached(version):
+            return True
 
-        if 'w' not in mode:
-            host, port = utils.get_host_port(self.srv)
-            with closing(HTTPConnection(host, port)) as con:
-                con.request('GET', filepath)
-                response = con.getresponse()
-                self.last_modified = response.getheader('Last-Modified')
-                status = response.status
+        for part in _fetch_chunks(chunks):
+            with part:
+                part.seek(0)
+                shutil.copyfileobj(part, self, _config['block_size'])
 
-                if status not in (200, 204):
-                    raise DFSIOError('Error (%d) while opening file.' % status)
+        if 'c' in self.mode:
+            File._cache.put(self.filepath, self.etag, self)
 
-                if status != 204:
-                    self.write(response.read())
+        return True
 
-                if 'r' in mode:
-                    self.seek(0)
+    def _open_cached(self, version):
+        """Use the content of the version of the file in the cache, return
+           False if it isn't there anymore.
+        """
 
-                self.lock_id = None
+        f = File._cache.open(self.filepath, version)
 
-        if 'a' in mode or 'w' in mode:
-            # automatically gets a lock if we're in write/append mode
-            host, port = utils.get_host_port(_config['lockserver'])
-            self.lock_id = int(utils.get_lock(filepath, host, port))
+        if f is None:
+            return False
 
-        if 'c' in mode:
-            File._cache[filepath] = self
+        if 'r' in self.mode and '+' not in self.mode:
+            # read-only, no need to copy it
+            self._file = f
+            self._rolled = True
+        else:
+            with f:
+                shutil.copyfileobj(f, self)
+
+        return True
 
     def __exit__(self, exc, value, tb):
         """Send the change to the DFS, and close the file."""
 
         self.close()
-
-        if 'c' not in self.mode:
-            return SpooledTemporaryFile.__exit__(self, exc, value, tb)
-
         return False
 
     def close(self):
-        """Send the change to the DFS, and close the file."""
+        """Send the change to the DFS, and close the file.
 
-        self.flush()
+           The lock of a cached writable file is kept a while (see
+           _LockKeeper), so it can be written again without waiting for a
+           new lock.
+        """
+
+        if self.closed:
+            return
 
-        if 'c' not in self.mode:
+        try:
+            self.sync()
+        finally:
             SpooledTemporaryFile.close(self)
+            self._release_lock()
+
+    def discard(self):
+        """Close the file without sending the changes."""
+
+        if self.closed:
+            return
+
+        _uploader.wait(self, cancel=True)
+        SpooledTemporaryFile.close(self)
+        self._release_lock()
 
     def flush(self):
-        """Flush the data to the server."""
+        """Flush the data to the server.
+
+           Write-back files (flag d) are only queued: they're copied and
+           sent in the background, after the upload in flight (if any),
+           and the flushes made meanwhile are coalesced.
+        """
 
         SpooledTemporaryFile.flush(self)
-        self.commit()
 
-    def commit(self):
-        """Send the local file to the remote fileserver."""
+        if self._write_back():
+            _uploader.submit(self)
+        else:
+            self.commit()
+
+    def sync(self):
+        """Flush the file and wait until the data is on the server (i.e.
+           the background uploads of a write-back file are done), raise a
+           DFSIOError if it couldn't be sent.
+        """
+
+        self.flush()
+
+        if self._write_back():
+            _uploader.wait(self)
+
+    def commit(self, f=None):
+        """Send the local file to the remote fileserver, only the blocks
+           which changed are sent when it's worth it (see _send_delta).
+
+           f: the content to send (a copy of the file, see flush), the
+              file itself by default.
+        """
 
         if 'a' in self.mode or 'w' in self.mode:
-            # send the file from the begining
+            f = self if f is None else f
+            position = f.tell()
+
+            if self.append_only:
+                self._send_append(f)
+                f.seek(position)
+                return
+
+            checksums = utils.block_checksums(f, _config['block_size'])
+
+            if self.base is not None and self.base[0] == checksums[0]:
+                # not modified since it was downloaded/sent
+                f.seek(position)
+                return
+
+            self._send(f, checksums)
+            self.base = checksums
+            f.seek(position)
+
+            if 'c' in self.mode:
+                File._cache.put(self.filepath, self.etag, f)
+
+    def _send(self, f, checksums):
+        """Send the content of f (see commit) in chunks if it's bigger than
+           chunk_size, otherwise as a regular file.
+
+           checksums: the utils.block_checksums of f.
+        """
+
+        chunk_size = _config['chunk_size']
+
+        if chunk_size is not None and _size(f) > chunk_size:
+            self._send_chunks(f)
+            return
+
+        # a file we don't know may have been stored in chunks (by a client
+        # whose chunk_size differs)
+        unknown = self.etag is None
+
+        if not self._send_delta(f, checksums):
+            self._send_whole(f)
+
+        if self.chunks is not None or unknown:
+            self._drop_chunks()
+
+    def _send_append(self, f):
+        """Append the data of f (see commit) which wasn't sent yet to the
+           remote file.
+        """
+
+        size = _size(f)
+
+        if size == self.appended:
+            return
+
+        status, _ = _append(self.filepath, f, self.appended, self.lock_id)
+
+        if status == 204:
+            self._append_missing(f)
+        elif status != 200:
+            raise DFSIOError('Error (%d) while appending to the file.'
+                             % status)
+
+        self.appended = size
+
+        if 'c' in self.mode:
+            # we don't have the whole content
+            File._cache.discard(self.filepath)
+
+    def _append_missing(self, f):
+        """The remote file doesn't exist: if it's stored in chunks, send
+           them again with the data of f to append (see _send_append),
+           otherwise create it.
+        """
+
+        host, port = utils.get_host_port(_config['nameserver'])
+        chunks = utils.get_chunks(self.filepath, host, port)
+
+        if chunks is None:
+            status, _ = _append(self.filepath, f, self.appended,
+                                self.lock_id, create=True)
+
+            if status != 200:
+                raise DFSIOError('Error (%d) while appending to the file.'
+                                 % status)
+            return
+
+        with SpooledTemporaryFile(_config['max_size'], 'w+b') as whole:
+            for part in _fetch_chunks(chunks):
+                with part:
+                    part.seek(0)
+                    shutil.copyfileobj(part, whole, _config['block_size'])
+
+            f.seek(self.appended)
+            shutil.copyfileobj(f, whole, _config['block_size'])
+
+            self.chunks = chunks
+            self._send(whole, utils.block_checksums(whole,
+                                                    _config['block_size']))
+
+    def _write_back(self):
+        """Return True if the file is sent in the background (flag d)."""
+
+        return 'd' in self.mode and ('a' in self.mode or 'w' in self.mode)
+
+    def _snapshot(self):
+        """Return a copy of the content of the file, which can be sent
+           while the file is written (from another thread).
+        """
+
+        with self._spool_lock:
+            position = self.tell()
+            snapshot = SpooledTemporaryFile(_config['max_size'], 'w+b')
             self.seek(0)
-            data = self.read()
-            host, port = utils.get_host_port(self.srv)
-            with closing(HTTPConnection(host, port)) as con:
-                con.request('PUT', self.filepath + '?lock_id=%s' % self.lock_id,
-                            data)
-
-                response = con.getresponse()
-                self.last_modified = response.getheader('Last-Modified')
-                status = response.status
-                if status != 200:
-                    raise DFSIOError('Error (%d) while committing change to'
-                                     ' the file.' % status)
+            shutil.copyfileobj(self, snapshot)
+            self.seek(position)
+
+        return snapshot
+
+    def _release_lock(self):
+        """Revoke the lock (or the shared lease) on the file, if any (it's
+           kept idle instead if keep_lock, see _LockKeeper).
+        """
 
         if self.lock_id is not None:
-            host, port = utils.get_host_port(_config['lockserver'])
-            utils.revoke_lock(self.filepath, host, port, self.lock_id)
+            host, port = _lockserver(self.filepath)
+
+            if not _keeper.release(self.filepath, self.lock_id,
+                                   self.keep_lock):
+                # the other clients can take it until it's used again
+                utils.idle_lock(self.filepath, host, port, self.lock_id)
+            elif self.owns_lock:
+                utils.revoke_lock(self.filepath, host, port, self.lock_id)
+
+            self.lock_id = None
+
+    def _send_whole(self, f):
+        """PUT the whole content of f (see commit) on the remote
+           fileserver.
+        """
+
+        # send the file from the begining, httplib streams it by
+        # blocks instead of loading it in memory
+        headers = {'Content-Length': str(_size(f))}
+        f.seek(0)
+
+        with _fileserver('PUT', self.filepath, '?lock_id=%s' % self.lock_id,
+                         f, headers) as response:
+            response.read()
+            status = response.status
+
+        if status != 200:
+            raise DFSIOError('Error (%d) while committing change to'
+                             ' the file.' % status)
+
+        self.etag = response.getheader('ETag')
+        self.last_modified = response.getheader('Last-Modified')
+
+    def _send_delta(self, f, checksums):
+        """PATCH the remote file with the blocks of f (see commit) which
+           differ from the last known version of the file (self.base, or
+           the checksums of the remote file if we don't know any version).
+
+           checksums: the utils.block_checksums of f.
+
+           Return False if nothing was sent, because it's not worth it (too
+           many blocks changed) or because the remote file isn't the one
+           we know anymore.
+        """
+
+        block_size = _config['block_size']
+        size = _size(f)
+        etag, base = self.etag, self.base
+
+        if base is None and size > block_size:
+            etag, base = self._remote_checksums()
+
+        if etag is None or base is None:
+            return False
+
+        base_sums = base[1]
+        changed = [n for n, s in enumerate(checksums[1])
+                   if n >= len(base_sums) or s != base_sums[n]]
+
+        if len(changed) * block_size > size / 2:
+            return False
+
+        delta = SpooledTemporaryFile(_config['max_size'])
+
+        # contiguous blocks are sent as one record
+        for first, last in _runs(changed):
+            offset = first * block_size
+            length = min((last + 1) * block_size, size) - offset
+            f.seek(offset)
+            delta.write('%d %d\n' % (offset, length))
+            delta.write(f.read(length))
+
+        headers = {'Content-Length': str(delta.tell()),
+                   'If-Match': etag}
+        delta.seek(0)
+
+        with _fileserver('PATCH', self.filepath,
+                         '?lock_id=%s&length=%d' % (self.lock_id, size),
+                         delta, headers) as response:
+            response.read()
+            status = response.status
+
+        delta.close()
+
+        if status in (204, 412):
+            # the remote file was deleted/modified by someone else
+            return False
+
+        if status != 200:
+            raise DFSIOError('Error (%d) while committing change to'
+                             ' the file.' % status)
+
+        self.etag = response.getheader('ETag')
+        self.last_modified = response.getheader('Last-Modified')
+        return True
+
+    def _send_chunks(self, f):
+        """Store the content of f (see commit) in chunks of chunk_size
+           bytes, spread over the fileservers (see NameServer), only the
+           chunks which aren't in the last known chunk map are sent, in
+           parallel, each one to all the servers allocated for it. The
+           former chunks and the former regular file are then removed.
+        """
+
+        chunk_size = _config['chunk_size']
+        count = (_size(f) + chunk_size - 1) // chunk_size
+        host, port = utils.get_host_port(_config['nameserver'])
+        new = utils.allocate_chunks(self.filepath, count, host, port)
+        known = dict((md5, (chunk_id, srv))
+                     for chunk_id, srv, _, md5 in self.chunks or [])
+        chunks = [None] * count
+        lock = threading.Lock()
+
+        def send(n):
+            part = SpooledTemporaryFile(_config['max_size'], 'w+b')
+
+            with part:
+                # f is shared by the threads
+                with lock:
+                    f.seek(n * chunk_size)
+                    md5 = _copy_chunk(f, part, chunk_size)
+
+                size = part.tell()
+
+                if md5 in known:
+                    chunks[n] = known[md5] + (size, md5)
+                    return
+
+                chunk_id, srv = new[n]
+                # recorded before sending, so that the copies already sent
+                # are removed if another one fails
+                chunks[n] = (chunk_id, srv, size, md5)
+
+                for replica in utils.get_replicas(srv):
+                    part.seek(0)
+
+                    with utils.pool.connection(
+                            *utils.get_host_port(replica)) as con:
+                        response = utils.request(con, 'PUT',
+                                                 '/.chunks/' + chunk_id, part,
+                                                 {'Content-Length': str(size)})
+                        response.read()
+
+                    if response.status != 200:
+                        raise DFSIOError('Error (%d) while sending the chunk'
+                                         ' %s to %s.' % (response.status,
+                                                         chunk_id, replica))
+
+        errors = _parallel(send, xrange(count), _config['parallel_chunks'])
+        sent = [chunk for chunk in chunks
+                if chunk is not None and chunk[3] not in known]
+
+        if errors:
+            _delete_chunks(sent)
+            raise DFSIOError('Unable to send %d chunks of %s (%s).'
+                             % (len(errors), self.filepath, errors[0]))
+
+        former = utils.set_chunks(self.filepath, chunks, host, port)
+        kept = set(chunk[0] for chunk in chunks)
+        _delete_chunks([chunk for chunk in former if chunk[0] not in kept])
+
+        if self.chunks is None:
+            # it was (maybe) a regular file
+            with _fileserver('DELETE', self.filepath,
+                             '?lock_id=%s' % self.lock_id) as response:
+                response.read()
+
+        self.chunks = chunks
+        self.etag = _chunks_etag(chunks)
+        self.last_modified = None
+
+    def _drop_chunks(self):
+        """Remove the chunk map of the file (which is a regular file now),
+           and its chunks.
+        """
+
+        host, port = utils.get_host_port(_config['nameserver'])
+        _delete_chunks(utils.set_chunks(self.filepath, None, host, port))
+        self.chunks = None
+
+    def _remote_checksums(self):
+        """Return the ETag and the checksums of the remote file (see
+           _send_delta) or (None, None) if it doesn't exist.
+        """
+
+        query = '?checksums=1&block_size=%d&lock_id=%s' % (
+                _config['block_size'], self.lock_id)
+
+        with _fileserver('GET', self.filepath, query) as response:
+            status, data = response.status, response.read()
+
+        if status != 200:
+            return None, None
+
+        lines = data.split('\n')
+        return response.getheader('ETag'), (lines[0], lines[1:])
 
     @staticmethod
-    def from_cache(filepath):
-        """Try to retrieve a file from the cache, the mode isn't specified,
-           it's up to the user to deal with it, otherwise we may have multiple
-           instance of the same file open in different mode.
+    def from_cache(filepath, mode='rc'):
+        """Try to open a file using the content in the cache.
 
            filepath: the path of the file to retrieve from cache.
+           mode: see File (c is implied).
 
-           Return None if the file isn't in the cache or if the cache expired.
+           Return None if the file isn't in the cache. If the cache expired
+           the new version is downloaded by the same request.
         """
 
-        if filepath in File._cache:
-            f = File._cache[filepath]
+        if 'c' not in mode:
+            mode += 'c'
 
-            host, port = utils.get_host_port(_config['nameserver'])
-            fs = utils.get_server(filepath, host, port)
-            host, port = utils.get_host_port(fs)
+        try:
+            return File(filepath, mode, cached_only=True)
+        except CacheMiss:
+            return None
 
-            with closing(HTTPConnection(host, port)) as con:
-                con.request('HEAD', filepath)
 
-                if (f.last_modified ==
-                        con.getresponse().getheader('Last-Modified')):
-                    f.seek(0)
-                    return f
-                else:
-                    del File._cache[filepath]
+class _RangeReader:
+    """Read-only file-like object which downloads the blocks of a remote
+       file with ranged GETs when they are read.
+
+       At most lazy_cache_blocks blocks are kept (the least recently used
+       are dropped) and when the blocks are read sequentially, more and
+       more of the following blocks are requested at once (up to
+       readahead_blocks).
+    """
+
+    def __init__(self, filepath, version=None, lock_id=None):
+        """filepath: the path of the distant file
+           version: if not None, the ETag of the version the caller
+                    already has, not_modified is True (and nothing is
+                    fetched) if it's still the current one
+           lock_id: the shared lease to send with the requests
+        """
+
+        self.filepath = filepath
+        self.lock_id = lock_id
+        self.block_size = _config['block_size']
+        self.closed = False
+        self.position = 0
+        self.blocks = collections.OrderedDict()
+        self.readahead = 1
+        # the block following the last fetched one
+        self.next_block = 0
+
+        # the first block also give us the size of the file
+        self.size = None
+        self.etag = None
+        self.last_modified = None
+        self.not_modified = False
+        # True if the file doesn't exist (e.g. it's stored in chunks)
+        self.missing = False
+        self._fetch(0, 1, version)
+
+    def _fetch(self, first, count, version=None):
+        """Download count blocks starting from the block first (see
+           __init__ for version).
+        """
+
+        start = first * self.block_size
+        end = start + count * self.block_size - 1
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+
+        if version is not None:
+            headers['If-None-Match'] = version
+        elif self.etag is not None:
+            # the following blocks must be from the same version
+            headers['If-Match'] = self.etag
+
+        query = '?lock_id=%s' % self.lock_id if self.lock_id else ''
+
+        with _fileserver('GET', self.filepath, query,
+                         headers=headers) as response:
+            status, data = response.status, response.read()
+
+        if status == 304:
+            self.not_modified = True
+            return
+
+        if status == 206:
+            content_range = response.getheader('Content-Range')
+            self.size = int(content_range.rsplit('/', 1)[1])
+        elif status in (200, 204):
+            # the whole file (e.g. it's empty)
+            start, self.size = 0, len(data)
+            self.missing = status == 204
+        elif status == 412:
+            raise DFSIOError('The file %s was modified while being read.'
+                             % self.filepath)
+        else:
+            raise DFSIOError('Error (%d) while reading file.' % status)
+
+        self.etag = response.getheader('ETag')
+        self.last_modified = response.getheader('Last-Modified')
+
+        for offset in xrange(0, len(data), self.block_size):
+            n = (start + offset) // self.block_size
+            self.blocks[n] = data[offset:offset + self.block_size]
+
+        self.next_block = -(-(start + len(data)) // self.block_size)
+
+        while len(self.blocks) > _config['lazy_cache_blocks']:
+            self.blocks.popitem(last=False)
+
+    def _block(self, n):
+        """Return the block n, download it if needed."""
+
+        if n not in self.blocks:
+            if n == self.next_block:
+                # sequential access
+                self.readahead = min(self.readahead * 2,
+                                     _config['readahead_blocks'])
+            else:
+                self.readahead = 1
+
+            last = (self.size - 1) // self.block_size
+            self._fetch(n, min(self.readahead, last - n + 1))
+
+        if n not in self.blocks:
+            raise DFSIOError('The block %d of %s is missing.'
+                             % (n, self.filepath))
+
+        block = self.blocks.pop(n)
+        self.blocks[n] = block
+
+        return block
+
+    def read(self, size=-1):
+        """See file.read."""
+
+        self._raise_if_closed()
+
+        if size < 0 or self.position + size > self.size:
+            size = max(self.size - self.position, 0)
+
+        parts = []
+
+        while size > 0:
+            n, offset = divmod(self.position, self.block_size)
+            part = self._block(n)[offset:offset + size]
+            self._raise_if_short(part)
+            parts.append(part)
+            size -= len(part)
+            self.position += len(part)
+
+        return ''.join(parts)
+
+    def readline(self, size=-1):
+        """See file.readline."""
+
+        self._raise_if_closed()
+
+        if size < 0 or self.position + size > self.size:
+            size = max(self.size - self.position, 0)
+
+        parts = []
+
+        while size > 0:
+            n, offset = divmod(self.position, self.block_size)
+            part = self._block(n)[offset:offset + size]
+            self._raise_if_short(part)
+            eol = part.find('\n')
+
+            if eol != -1:
+                part = part[:eol + 1]
+
+            parts.append(part)
+            size -= len(part)
+            self.position += len(part)
+
+            if eol != -1:
+                break
+
+        return ''.join(parts)
+
+    def readlines(self, sizehint=0):
+        """See file.readlines."""
+
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """See file.next."""
+
+        line = self.readline()
+
+        if not line:
+            raise StopIteration
+
+        return line
+
+    def xreadlines(self):
+        return self
+
+    def seek(self, offset, whence=0):
+        """See file.seek."""
+
+        self._raise_if_closed()
+
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+
+        if offset < 0:
+            raise IOError(22, 'Invalid argument')
+
+        self.position = offset
+
+    def tell(self):
+        """See file.tell."""
+
+        self._raise_if_closed()
+        return self.position
+
+    def flush(self):
+        pass
+
+    def write(self, s):
+        raise IOError('File not open for writing')
+
+    writelines = truncate = write
+
+    def close(self):
+        """Drop the cached blocks."""
+
+        self.closed = True
+        self.blocks.clear()
 
-        return None
+    def _raise_if_closed(self):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+    def _raise_if_short(self, part):
+        """Raise a DFSIOError if part (read at the position) is empty, i.e.
+           the blocks sent by the fileserver are shorter than the size of
+           the file.
+        """
+
+        if not part:
+            raise DFSIOError('Unable to read %s at offset %d.'
+                             % (self.filepath, self.position))
+
+
+class _LockKeeper:
+    """Keep the locks (and shared leases) held by the client alive: a
+       background thread renews them all, in one request per lockserver,
+       every heartbeat_interval seconds.
+
+       The lock of a closed cached writable file isn't revoked but kept
+       idle for lock_keep seconds, so opening the file again for writing
+       doesn't need a new lock (see take). The lockserver is told it's
+       idle, so it revokes it if another client asks for the file
+       meanwhile, and that it's used again when it's taken (see
+       utils.idle_lock). The locks of the files which are garbage
+       collected without being closed are revoked.
+    """
+
+    def __init__(self):
+        # (filepath, lock_id) → weak reference to the File using the lock
+        self.used = {}
+        # filepath → (lock_id, time it was released) of the idle locks
+        self.idle = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def take(self, filepath, f):
+        """Return the idle lock of filepath, now used by the File f (or None
+           if there's no such lock).
+        """
+
+        with self._lock:
+            if filepath not in self.idle:
+                return None
+
+            lock_id, _ = self.idle.pop(filepath)
+            self.used[filepath, lock_id] = weakref.ref(f)
+
+            return lock_id
+
+    def add(self, filepath, lock_id, f):
+        """Keep lock_id, used by the File f, alive until it's released."""
+
+        with self._lock:
+            self.used[filepath, lock_id] = weakref.ref(f)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._renew_forever)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def release(self, filepath, lock_id, keep=False):
+        """Stop using lock_id, keep it idle if keep, otherwise return True
+           (it must be revoked by the caller).
+        """
+
+        with self._lock:
+            self.used.pop((filepath, lock_id), None)
+
+            if keep and _config['lock_keep'] > 0:
+                self.idle[filepath] = (lock_id, time.time())
+                return False
+
+        return True
+
+    def renew(self):
+        """Renew all the locks, and revoke the ones which aren't used
+           anymore (idle for more than lock_keep seconds, or whose File
+           was garbage collected).
+        """
+
+        now = time.time()
+
+        with self._lock:
+            unused = [key for key, ref in self.used.items() if ref() is None]
+            unused.extend((filepath, lock_id)
+                          for filepath, (lock_id, released)
+                          in self.idle.items()
+                          if now - released > _config['lock_keep'])
+
+            for filepath, lock_id in unused:
+                self.used.pop((filepath, lock_id), None)
+                self.idle.pop(filepath, None)
+
+            locks = self.used.keys() + [(filepath, lock_id)
+                    for filepath, (lock_id, _) in self.idle.items()]
+
+        if unused:
+            utils.revoke_locks(unused, _config['lockserver'])
+
+        if locks:
+            lost = utils.renew_locks(locks, _config['lockserver'])
+
+            with self._lock:
+                for filepath in lost:
+                    if filepath in self.idle:
+                        del self.idle[filepath]
+                    else:
+                        logging.warning('The lock on %s was lost.', filepath)
+
+    def close(self):
+        """Revoke the idle locks."""
+
+        with self._lock:
+            idle = [(filepath, lock_id)
+                    for filepath, (lock_id, _) in self.idle.items()]
+            self.idle.clear()
+
+        if idle:
+            utils.revoke_locks(idle, _config['lockserver'])
+
+    def _renew_forever(self):
+        """Call renew every heartbeat_interval seconds."""
+
+        while True:
+            time.sleep(_config['heartbeat_interval'])
+
+            try:
+                self.renew()
+            except Exception as e:
+                logging.warning('Unable to renew the locks: %s', e)
+
+
+class _Uploader:
+    """Send the write-back files (see File.flush) in the background, with
+       at most parallel_uploads threads.
+
+       Each file has at most one upload in flight, its content is copied
+       when the upload starts (see File._snapshot), so the flushes made
+       meanwhile only mark it as pending again.
+    """
+
+    def __init__(self):
+        # Files waiting to be sent, in FIFO order
+        self.pending = []
+        # Files being sent
+        self.busy = set()
+        # File → exception raised by its last failed upload
+        self.errors = {}
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, f):
+        """Send the content of the File f as soon as possible."""
+
+        with self._cond:
+            if f not in self.pending:
+                self.pending.append(f)
+
+            if len(self._threads) < _config['parallel_uploads']:
+                thread = threading.Thread(target=self._upload_forever)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+            self._cond.notify_all()
+
+    def wait(self, f, cancel=False):
+        """Wait until the content of the File f is sent, and raise a
+           DFSIOError if one of its uploads failed.
+
+           cancel: if True, drop the content which isn't sent yet instead.
+        """
+
+        with self._cond:
+            if cancel and f in self.pending:
+                self.pending.remove(f)
+
+            while f in self.pending or f in self.busy:
+                self._cond.wait()
+
+            error = self.errors.pop(f, None)
+
+        if error is not None and not cancel:
+            raise DFSIOError('Unable to send %s (%s).' % (f.filepath, error))
+
+    def close(self):
+        """Wait until all the files are sent."""
+
+        with self._cond:
+            while self.pending or self.busy:
+                self._cond.wait()
+
+    def _upload_forever(self):
+        """Send the pending files, one at a time."""
+
+        while True:
+            with self._cond:
+                f = next((f for f in self.pending if f not in self.busy),
+                         None)
+
+                while f is None:
+                    self._cond.wait()
+                    f = next((f for f in self.pending
+                              if f not in self.busy), None)
+
+                self.pending.remove(f)
+                self.busy.add(f)
+
+            snapshot = None
+
+            try:
+                snapshot = f._snapshot()
+                f.commit(snapshot)
+            except Exception as e:
+                logging.exception(e)
+
+                with self._cond:
+                    self.errors[f] = e
+            finally:
+                if snapshot is not None:
+                    snapshot.close()
+
+                with self._cond:
+                    self.busy.discard(f)
+                    self._cond.notify_all()
+
+
+def _runs(numbers):
+    """Yield the (first, last) of each run of consecutive numbers of the
+       sorted list numbers, e.g.: [1, 2, 3, 7, 9, 10] → (1, 3), (7, 7), (9, 10)
+    """
+
+    first = last = None
+
+    for n in numbers:
+        if last is not None and n == last + 1:
+            last = n
+            continue
+
+        if first is not None:
+            yield first, last
+
+        first = last = n
+
+    if first is not None:
+        yield first, last
+
+
+def _size(f):
+    """Return the size of the file-like object f."""
+
+    position = f.tell()
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(position)
+
+    return size
+
+
+def _append(filepath, f, start, lock_id=None, create=False):
+    """POST the content of f, from start to its end, to append it to
+       filepath (see FileServer.POST), return the status and the body of
+       the response (the offset where it was written).
+
+       create: if True, create filepath if it doesn't exist.
+    """
+
+    query = ['lock_id=%s' % lock_id] if lock_id else []
+
+    if create:
+        query.append('create=1')
+
+    query = '?' + '&'.join(query) if query else ''
+    headers = {'Content-Length': str(_size(f) - start)}
+
+    for retry in (False, True):
+        f.seek(start)
+
+        with _fileserver('POST', filepath, query, f, headers,
+                         primary=True) as response:
+            status, body = response.status, response.read()
+
+        if status != 409:
+            break
+
+        # the fileserver missed appends, it's up to date now (see
+        # FileServer.POST)
+
+    return status, body
+
+
+def _chunks_etag(chunks):
+    """Return the version of a file stored in chunks (a new version of a
+       chunk has a new id).
+    """
+
+    return '"%s"' % hashlib.md5(' '.join(chunk[0]
+                                         for chunk in chunks)).hexdigest()
+
+
+def _copy_chunk(src, dst, length):
+    """Copy at most length bytes from src to dst, return their md5."""
+
+    md5 = hashlib.md5()
+
+    while length > 0:
+        data = src.read(min(length, _config['block_size']))
+
+        if not data:
+            break
+
+        md5.update(data)
+        dst.write(data)
+        length -= len(data)
+
+    return md5.hexdigest()
+
+
+def _fetch_chunks(chunks):
+    """Download the chunks (see utils.get_chunks) in parallel, each one
+       from the first of its servers which has it, return their contents
+       (SpooledTemporaryFile), in order.
+    """
+
+    parts = [SpooledTemporaryFile(_config['max_size'], 'w+b')
+             for _ in chunks]
+
+    def fetch(n):
+        chunk_id, srv, size, _ = chunks[n]
+        error = None
+
+        for replica in utils.get_replicas(srv):
+            parts[n].seek(0)
+            parts[n].truncate()
+
+            try:
+                with utils.pool.connection(
+                        *utils.get_host_port(replica)) as con:
+                    response = utils.request(con, 'GET',
+                                             '/.chunks/' + chunk_id)
+
+                    if response.status == 200:
+                        shutil.copyfileobj(response, parts[n],
+                                           _config['block_size'])
+                    else:
+                        response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                error = e
+                continue
+
+            if response.status == 200 and parts[n].tell() == size:
+                return
+
+            error = 'error %d from %s' % (response.status, replica)
+
+        raise DFSIOError('Unable to read the chunk %s (%s).'
+                         % (chunk_id, error))
+
+    errors = _parallel(fetch, xrange(len(chunks)), _config['parallel_chunks'])
+
+    if errors:
+        for part in parts:
+            part.close()
+
+        raise DFSIOError('Unable to read %d chunks (%s).'
+                         % (len(errors), errors[0]))
+
+    return parts
+
+
+def _delete_chunks(chunks):
+    """Remove the chunks (see utils.get_chunks) from all their fileservers,
+       in parallel (the failures are just logged).
+    """
+
+    def delete(item):
+        chunk_id, srv = item
+
+        with utils.pool.connection(*utils.get_host_port(srv)) as con:
+            response = utils.request(con, 'DELETE', '/.chunks/' + chunk_id)
+            response.read()
+
+        if response.status not in (200, 204):
+            raise DFSIOError('Error (%d) while deleting the chunk %s from %s.'
+                             % (response.status, chunk_id, srv))
+
+    _parallel(delete, [(chunk[0], replica) for chunk in chunks
+                       for replica in utils.get_replicas(chunk[1])],
+              _config['parallel_chunks'])
+
+
+def _get_server(filepath, renew=False):
+    """Return the fileserver serving filepath, raise a DFSIOError if
+       there's none.
+
+       renew: if True, don't use the cached answer of the nameserver.
+    """
+
+    host, port = utils.get_host_port(_config['nameserver'])
+
+    if _config['names_sync']:
+        _sync_names(renew)
+        srv = _names.get_server(filepath)
+
+    elif renew:
+        srv = utils.get_server.renew(filepath, host, port)
+    else:
+        srv = utils.get_server(filepath, host, port)
+
+    if srv is None:
+        raise DFSIOError('Impossible to find a server that serve %s.'
+                % filepath)
+
+    return srv
+
+
+def _lockserver(filepath):
+    """Return the address (host, port) of the lockserver of filepath (see
+       utils.get_lockserver).
+    """
+
+    return utils.get_lockserver(filepath, _config['lockserver'])
+
+
+def _sync_names(force=False):
+    """Update the local copy of the names mapping if it's older than
+       names_sync_interval seconds (or if force).
+    """
+
+    if force or time.time() - _names.synced > _config['names_sync_interval']:
+        host, port = utils.get_host_port(_config['nameserver'])
+        _names.sync(host, port)
+
+
+@contextmanager
+def _fileserver(method, filepath, query='', body=None, headers={},
+                primary=False):
+    """Send a request about filepath to its fileserver and yield the
+       response (which must be read entirely).
+
+       The request is sent to the replica of filepath picked by
+       _replicas, or to the next ones if it's down. If a read finds no
+       file on a replica which isn't the primary one (see _replicas), it
+       may have missed the writes (e.g. it's just back), so the request
+       is sent again to the primary replica.
+
+       If the fileserver answers '406 Not Acceptable', it doesn't serve
+       filepath anymore (e.g. the directory moved to another server), so
+       filepath is resolved again and the request is sent to the new
+       fileserver.
+
+       primary: see _replicas.
+    """
+
+    start = body.tell() if hasattr(body, 'read') else None
+    srv = _get_server(filepath)
+
+    for retry in (False, True):
+        con, response = _request_replicas(_replicas(filepath, srv,
+                                                    primary),
+                                          method, filepath + query, body,
+                                          headers)
+
+        if _may_lag(method, response, con, filepath, srv):
+            response.read()
+            utils.pool.release(con)
+            con, response = _request_replicas(_replicas(filepath, srv,
+                                                        True),
+                                              method, filepath + query,
+                                              body, headers)
+
+        done = response.status != 406 or retry
+
+        try:
+            if done:
+                yield response
+            else:
+                response.read()
+        except:
+            con.close()
+            raise
+
+        utils.pool.release(con)
+
+        if done:
+            return
+
+        srv = _get_server(filepath, renew=True)
+
+        if start is not None:
+            body.seek(start)
+
+
+def _replicas(filepath, srv, primary=False):
+    """Return the list of the fileservers of the replica set srv, in the
+       order they should be tried.
+
+       That's the order of the nameserver: the least loaded servers first
+       (the ETags are the same on all the replicas, so the requests about
+       a file can go to any of them). With names_sync the names have no
+       load, the list is rotated by a hash of filepath and of this client
+       instead, so the requests about a file are spread over its replicas
+       by the clients.
+
+       primary: if True (for the appends), the order only depends on
+                filepath, so all the clients send the appends of a file
+                to the same server, which orders them (the other replicas
+                append them at the same offsets, see FileServer.POST).
+    """
+
+    replicas = utils.get_replicas(srv)
+
+    if primary and len(replicas) > 1:
+        replicas.sort()
+        n = int(hashlib.md5(filepath).hexdigest(), 16) % len(replicas)
+        return replicas[n:] + replicas[:n]
+
+    if len(replicas) > 1 and _config['names_sync']:
+        replicas.sort()
+        n = hash((_seed, filepath)) % len(replicas)
+        replicas = replicas[n:] + replicas[:n]
+
+    return replicas
+
+
+def _may_lag(method, response, con, filepath, srv):
+    """Return True if response (from the connection con) says the file
+       read doesn't exist, and doesn't come from the primary replica of
+       filepath in the replica set srv (see _replicas).
+    """
+
+    if method not in ('GET', 'HEAD') or response.status not in (204, 404):
+        return False
+
+    primary = _replicas(filepath, srv, True)[0]
+    return (con.host, con.port) != utils.get_host_port(primary)
+
+
+def _request_replicas(replicas, method, url, body=None, headers={}):
+    """Send the request to the first replica which can be reached, return
+       the connection (to give back to utils.pool) and the response.
+
+       The requests which aren't idempotent (e.g. an append) are only sent
+       to the next replica if the connection to the former one fails:
+       once they're sent, they may have been handled (see utils.request).
+
+       The requests are also sent to the next replica if the file is
+       being resynced ('503 Service Unavailable', they weren't handled,
+       see fileserver._resync).
+    """
+
+    start = body.tell() if hasattr(body, 'read') else None
+    idempotent = method in ('GET', 'HEAD', 'PUT', 'DELETE')
+
+    for n, srv in enumerate(replicas):
+        con = utils.pool.acquire(*utils.get_host_port(srv))
+        sent = False
+
+        try:
+            if not idempotent:
+                if con.sock is None:
+                    con.connect()
+
+                sent = True
+
+            response = utils.request(con, method, url, body, headers)
+
+            if response.status != 503 or n == len(replicas) - 1:
+                return con, response
+
+            response.read()
+            utils.pool.release(con)
+            logging.info('%s is resyncing, trying the next replica.', srv)
+
+        except (socket.error, httplib.HTTPException) as e:
+            con.close()
+
+            if sent or n == len(replicas) - 1:
+                raise
+
+            logging.warning('Unable to reach %s (%s), trying the next'
+                            ' replica.', srv, e)
+
+        if start is not None:
+            body.seek(start)
+
+
+def resolve(filepaths):
+    """Ask the fileservers of all the filepaths to the nameserver in one
+       request (so the following opens don't have to), return a
+       dictionnary filepath → replica set (None if there's none, see
+       utils.get_replicas).
+    """
+
+    if _config['names_sync']:
+        _sync_names()
+        return dict((filepath, _names.get_server(filepath))
+                    for filepath in filepaths)
+
+    host, port = utils.get_host_port(_config['nameserver'])
+    return utils.get_servers(filepaths, host, port)
+
+
+@contextmanager
+def transaction(filepaths, mode='w'):
+    """Open all the filepaths in mode (w or a, see File), their locks are
+       granted at once (one request per lockserver, all or nothing), and
+       yield a dictionnary filepath → File.
+
+       When the block exits, the modified files are sent in parallel (at
+       most parallel_uploads at a time), then all the locks are revoked at
+       once. If the block raises an exception, nothing is sent.
+
+       e.g.:
+           with dfs.client.transaction(['/out/a', '/out/b']) as files:
+               files['/out/a'].write('...')
+    """
+
+    if 'w' not in mode and 'a' not in mode:
+        raise ValueError('Transactions are for writing (w or a modes).')
+
+    filepaths = sorted(set(filepaths))
+
+    try:
+        locks = utils.get_locks(filepaths, _config['lockserver'])
+    except Exception as e:
+        raise DFSIOError('Unable to lock all the files (%s).' % e)
+
+    files = {}
+
+    try:
+        for filepath in filepaths:
+            files[filepath] = File(filepath, mode, lock_id=locks[filepath])
+
+        yield files
+
+        errors = _parallel(File.close, files.values(),
+                           _config['parallel_uploads'])
+
+        if errors:
+            raise DFSIOError('Unable to send %d files (%s).'
+                             % (len(errors), errors[0]))
+
+    finally:
+        for f in files.values():
+            f.discard()
+
+        utils.revoke_locks(locks.items(), _config['lockserver'])
+
+
+def _parallel(fn, items, n):
+    """Call fn on all the items, in at most n threads, return the list of
+       the exceptions raised.
+    """
+
+    items = list(items)
+    errors = []
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not items:
+                    return
+
+                item = items.pop()
+
+            try:
+                fn(item)
+            except Exception as e:
+                logging.exception(e)
+
+                with lock:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=work)
+               for _ in xrange(min(n, len(items)))]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return errors
 
 
 def unlink(filepath, lock_id=None):
@@ -149,20 +1617,53 @@ def unlink(filepath, lock_id=None):
 
        If lock_id is provided, it's used to delete the file."""
 
-    # ns
-    host, port = utils.get_host_port(_config['nameserver'])
-    # fs
-    fs = utils.get_server(filepath, host, port)
-    host, port = utils.get_host_port(fs)
+    query = '?lock_id=%s' % lock_id if lock_id else ''
 
-    with closing(HTTPConnection(host, port)) as con:
-        con.request('DELETE', filepath + '?lock_id=%s' % lock_id)
+    with _fileserver('DELETE', filepath, query) as response:
+        response.read()
+        status = response.status
 
-        status = con.getresponse().status
+    if status == 204:
+        # maybe stored in chunks
+        host, port = utils.get_host_port(_config['nameserver'])
+        chunks = utils.set_chunks(filepath, None, host, port)
 
-        if status != 200:
-            raise DFSIOError('Error (%d) while deleting %s.' %
-                             (status, filepath))
+        if chunks:
+            _delete_chunks(chunks)
+            return
+
+    if status != 200:
+        raise DFSIOError('Error (%d) while deleting %s.' %
+                         (status, filepath))
+
+
+def append(filepath, data, lock_id=None):
+    """Append data to filepath (which is created if it doesn't exist) at
+       once, and return the offset where it was written (record append:
+       several clients can append to the same file at the same time, the
+       records are never interleaved).
+
+       The files stored in chunks don't support it.
+    """
+
+    with SpooledTemporaryFile(_config['max_size'], 'w+b') as f:
+        f.write(data)
+        status, offset = _append(filepath, f, 0, lock_id)
+
+        if status == 204:
+            host, port = utils.get_host_port(_config['nameserver'])
+
+            if utils.get_chunks(filepath, host, port) is not None:
+                raise DFSIOError('%s is stored in chunks, it doesn\'t'
+                                 ' support record appends.' % filepath)
+
+            status, offset = _append(filepath, f, 0, lock_id, create=True)
+
+    if status != 200:
+        raise DFSIOError('Error (%d) while appending to %s.'
+                         % (status, filepath))
+
+    return int(offset)
 
 
 def rename(filepath, newfilepath):
@@ -179,9 +1680,55 @@ open = File
 
 _config = {
         'nameserver': None,
+        # 'host:port', or a list of them (see utils.get_lockserver)
         'lockserver': None,
         'max_size': 1024 ** 2,
+        'block_size': 64 * 1024,
+        'lazy_cache_blocks': 64,
+        'readahead_blocks': 16,
+        # take a shared lease on the files opened for reading (otherwise
+        # they're just checked not to be locked)
+        'shared_leases': True,
+        'cache_dir': '.dfs-cache',
+        'cache_max_bytes': 256 * 1024 ** 2,
+        'cache_max_entries': 1024,
+        'resolve_ttl': 60,
+        'resolve_negative_ttl': 5,
+        'resolve_cache_size': 100000,
+        'names_sync': False,
+        'names_sync_interval': 10,
+        'pool_size': 4,
+        'pool_idle_timeout': 30,
+        # must be less than the lock_lifetime of the lockserver
+        'heartbeat_interval': 20,
+        # seconds the lock of a closed cached writable file is kept
+        'lock_keep': 30,
+        # number of files sent at once by a transaction, or in the
+        # background (see the d flag of File)
+        'parallel_uploads': 8,
+        # the files bigger than this are stored in chunks of this size
+        # (e.g. 64 * 1024 ** 2), None to store every file in one piece
+        'chunk_size': None,
+        # number of chunks sent/received at once
+        'parallel_chunks': 8,
+        # number of threads running the operations of dfs.aio
+        'aio_workers': 8,
          } # default
-File._cache = {}
 utils.load_config(_config, 'client.dfs.json')
+File._cache = cache.Cache(_config['cache_dir'], _config['cache_max_bytes'],
+                          _config['cache_max_entries'])
+_names = utils.NameMap()
+utils.get_server.ttl = _config['resolve_ttl']
+utils.get_server.negative_ttl = _config['resolve_negative_ttl']
+utils.get_server.max_size = _config['resolve_cache_size']
+utils.pool.max_size = _config['pool_size']
+utils.pool.idle_timeout = _config['pool_idle_timeout']
+# identifies this client, see _replicas
+_seed = random.getrandbits(32)
+_keeper = _LockKeeper()
+atexit.register(_keeper.close)
+# before the locks are revoked (the atexit functions are called in the
+# reverse order)
+_uploader = _Uploader()
+atexit.register(_uploader.close)
 
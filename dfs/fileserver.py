@@ -1,112 +1,1346 @@
 #-*- coding: utf-8 -*-
 
+import collections
+import datetime
+import errno
+import functools
+import hashlib
+import httplib
 import logging
 import os.path
+import shutil
+import socket
+import tempfile
+import threading
 import time
-
-from contextlib import closing
-from httplib import HTTPConnection
+import types
+import urllib
 
 import web
 
 import utils
 
+def _tracked(method):
+    """Decorator for the methods of FileServer: the request is active
+       while it's handled (until its body is sent if it's streamed, see
+       _stream), and the bytes it receives & sends (their Content-Length)
+       are counted, see _Load.
+    """
+
+    @functools.wraps(method)
+    def tracked(self, *args):
+        _load.begin(web.intget(web.ctx.env.get('CONTENT_LENGTH'), 0))
+
+        try:
+            result = method(self, *args)
+        except:
+            _load.end(0)
+            raise
+
+        length = web.intget(dict(web.ctx.headers).get('Content-Length'), 0)
+
+        if isinstance(result, types.GeneratorType):
+            return _tracked_body(result, length)
+
+        _load.end(length)
+        return result
+
+    return tracked
+
+
+def _tracked_body(body, length):
+    """Yield the chunks of body, and end the request (see _tracked) once
+       they're sent (or the client is gone).
+    """
+
+    try:
+        for chunk in body:
+            yield chunk
+    finally:
+        body.close()
+        _load.end(length)
+
+
 class FileServer:
     """Represent a fileserver which is responsible of holding & sharing
        files.
+
+       Every fileserver also stores chunks of the files stored in chunks
+       (see NameServer), as /.chunks/chunk_id: they're never modified
+       (a new version of a chunk has a new id), so they aren't locked,
+       nor replicated.
+
+       The directories are resynced from another replica (see _resync)
+       when the server starts, and when the nameserver says it missed
+       writes (see _heartbeat), the clients can't read nor write the
+       files of a directory being resynced meanwhile (the writes
+       forwarded by the other replicas are still applied).
     """
 
+    @_tracked
     def GET(self, filepath):
         """Return the requested file if it's not locked, or if the correct
            lock is provided using the lock_id var.
+
+           The file is streamed by chunks of chunk_size bytes (or handed
+           to the WSGI server, see sendfile), so it's never entirely
+           loaded in memory.
+
+           The ETag header identifies the version of the file, if it's
+           given in the If-None-Match header (or if the file wasn't
+           modified since If-Modified-Since) a '304 Not Modified' is sent
+           instead of the file.
+
+           If the If-Match header isn't the ETag of the file, a '412
+           Precondition Failed' is sent.
+
+           A single byte range can be requested with the Range header
+           (e.g. 'Range: bytes=0-4095'), only this part of the file is
+           then sent back with a '206 Partial Content'.
+
+           If the checksums var is present, return the checksums of the
+           file instead (see _get_checksums). If the list var is present,
+           filepath is one of our directories, return its files instead
+           (see _get_list).
+
+           If the directory of filepath is being resynced, a '503 Service
+           Unavailable' is sent (the client reads another replica). The
+           other replicas (the X-DFS-Replicated header) read the files
+           whatever their locks.
         """
 
         web.header('Content-Type', 'text/plain; charset=UTF-8')
+        i = web.input(_method='get')
+
+        if 'list' in i:
+            return _get_list(filepath)
 
         _raise_if_dir_or_not_servable(filepath)
+        _raise_if_dirty(filepath)
         _raise_if_not_exists(filepath)
         _raise_if_locked(filepath)
 
         p = _get_local_path(filepath)
-        web.header('Last-Modified', time.ctime(os.path.getmtime(p)))
-        with open(p) as f:
-            return f.read()
 
+        if 'checksums' in i:
+            _set_version_headers(p)
+            block_size = web.intget(i.get('block_size'), _config['block_size'])
+            return _get_checksums(p, block_size)
+
+        f = open(p, 'rb')
+        st, etag = _set_version_headers(p, f)
+        size = st.st_size
+
+        if _not_modified(st, etag):
+            f.close()
+            raise web.notmodified()
+
+        if web.ctx.env.get('HTTP_IF_MATCH', etag) != etag:
+            # e.g. the next range of a version which was replaced
+            f.close()
+            raise web.preconditionfailed()
+
+        web.header('Accept-Ranges', 'bytes')
+
+        try:
+            byte_range = _get_range(size)
+        except:
+            f.close()
+            raise
+
+        if byte_range is None:
+            web.header('Content-Length', str(size))
+            # the file may grow (e.g. appends) while it's being sent
+            web.ctx.dfs_file = _LimitedFile(f, size)
+
+            return _stream(f, size)
+
+        start, end = byte_range
+        web.ctx.status = '206 Partial Content'
+        web.header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        web.header('Content-Length', str(end - start + 1))
+        f.seek(start)
+
+        return _stream(f, end - start + 1)
+
+    @_tracked
     def PUT(self, filepath):
-        """Replace the file by the data in the request."""
+        """Replace the file by the data in the request.
+
+           The data is streamed into a temporary file which is then renamed
+           over the former file, so readers never see a partial file.
+
+           The new file is then sent to the other servers of the replica
+           set of the directory (see _replicate), the response is sent once
+           the whole chain has it.
+        """
 
         _raise_if_dir_or_not_servable(filepath)
-        _raise_if_locked(filepath)
+        _raise_if_dirty(filepath)
+        _raise_if_locked(filepath, write=True)
+
+        p = _get_local_path(filepath)
+
+        # maybe a new subdirectory of a served directory
+        _makedirs(os.path.dirname(p))
+
+        _receive(p)
+
+        cond = _append_locks[hash(p) % len(_append_locks)]
+
+        with cond:
+            # the appends waiting for the file to grow (see _append)
+            cond.notify_all()
+
+        _replicate(filepath, 'PUT', p)
+        _set_version_headers(p)
+
+        return ''
+
+    @_tracked
+    def PATCH(self, filepath):
+        """Apply a delta to the file, the request data is a list of
+           records, each one being a line 'offset length' followed by
+           length bytes to write at offset, e.g.:
+               0 5
+               hello65536 3
+               abc
+           The length var is the new size of the file (it can be used to
+           truncate the file).
+
+           The If-Match header must be the ETag of the version on which
+           the delta was computed, otherwise a '412 Precondition Failed'
+           is sent (and the client should send the whole file).
+
+           The replicas get the whole new file (see _replicate).
+        """
+
+        _raise_if_dir_or_not_servable(filepath)
+        _raise_if_dirty(filepath)
+        _raise_if_not_exists(filepath)
+        _raise_if_locked(filepath, write=True)
 
         p = _get_local_path(filepath)
+        i = web.input(_method='get')
+        length = web.intget(i.get('length'), None)
 
-        with open(p, 'w') as f:
-            f.write(web.data())
+        if length is None:
+            raise web.badrequest()
 
-        web.header('Last-Modified', time.ctime(os.path.getmtime(p)))
+        if web.ctx.env.get('HTTP_IF_MATCH') != _etag(p):
+            raise web.preconditionfailed()
+
+        _patch(p, length)
+        _replicate(filepath, 'PUT', p)
+        _set_version_headers(p)
 
         return ''
 
+    @_tracked
+    def POST(self, filepath):
+        """Append the data in the request at the end of the file, and
+           return the offset where it was written.
+
+           The data is received first, then written at once (the appends
+           to a file are serialized), so the data of concurrent appenders
+           (see dfs.client.append) is never interleaved.
+
+           If the file doesn't exist a '204 No Content' is sent, unless
+           the create var is given (the client may have to look for its
+           chunks first, see NameServer).
+
+           The data is then appended on the other servers of the replica
+           set at the same offset (see _replicate), so the order of the
+           appends is the one of the server they were sent to (the
+           clients send all the appends of a file to the same server, see
+           dfs.client._replicas). With the offset var, the data must be
+           written at offset (see _append), the replicas which missed
+           appends are brought up to date, and if it's this server a '409
+           Conflict' is sent: the data wasn't appended (see
+           _append_conflict).
+        """
+
+        web.header('Content-Type', 'text/plain; charset=UTF-8')
+
+        _raise_if_dir_or_not_servable(filepath)
+        _raise_if_dirty(filepath)
+        i = web.input(_method='get')
+
+        if 'create' not in i:
+            _raise_if_not_exists(filepath)
+
+        _raise_if_locked(filepath, write=True)
+
+        p = _get_local_path(filepath)
+
+        _makedirs(os.path.dirname(p))
+
+        fd, tmp = tempfile.mkstemp(prefix='.dfs-', dir=os.path.dirname(p))
+        os.close(fd)
+
+        try:
+            _receive(tmp, False)
+            offset = _append(p, tmp, web.intget(i.get('offset'), None))
+            _replicate(filepath, 'POST', tmp, offset)
+        finally:
+            os.unlink(tmp)
+
+        _set_version_headers(p)
+
+        return str(offset)
+
+    @_tracked
     def DELETE(self, filepath):
         """Remove the filepath if it's unlocked, or if the correct
-           lock_id is supplied in 'lock_id'.
+           lock_id is supplied in 'lock_id' (on the whole replication
+           chain, see _replicate), answer '204 No Content' if it didn't
+           exist on this server.
         """
 
         web.header('Content-Type', 'text/plain; charset=UTF-8')
 
         _raise_if_dir_or_not_servable(filepath)
-        _raise_if_not_exists(filepath)
-        _raise_if_locked(filepath)
+        _raise_if_dirty(filepath)
+        # before the 204 of a missing file, which lets the client remove
+        # the files stored in chunks (see dfs.client.unlink)
+        _raise_if_locked(filepath, write=True)
+
+        p = _get_local_path(filepath)
+        exists = os.path.exists(p)
+
+        if exists:
+            os.unlink(p)
+
+        # even if it's missing here, the next replicas may have missed the
+        # former DELETE (e.g. they were down)
+        _replicate(filepath, 'DELETE')
+
+        if not exists:
+            _raise_if_not_exists(filepath)
 
-        os.unlink(_get_local_path(filepath))
         return 'OK'
 
+    @_tracked
     def HEAD(self, filepath):
-        """If the file exists/isn't locked, return the last-modified http
-           header which corresponds to the last time was modified."""
+        """If the file exists/isn't locked, return the ETag & Last-Modified
+           headers which identify the current version of the file (see
+           GET for the conditional requests)."""
 
         web.header('Content-Type', 'text/plain; charset=UTF-8')
 
         _raise_if_dir_or_not_servable(filepath)
+        _raise_if_dirty(filepath)
         _raise_if_not_exists(filepath)
         _raise_if_locked(filepath)
 
-        p = _get_local_path(filepath)
-        web.header('Last-Modified', time.ctime(os.path.getmtime(p)))
+        st, etag = _set_version_headers(_get_local_path(filepath))
+
+        if _not_modified(st, etag):
+            raise web.notmodified()
+
         return ''
 
 
+def sendfile(wsgi):
+    """WSGI middleware, if the server provides wsgi.file_wrapper (which
+       usually relies on sendfile(2), i.e. zero-copy) the file returned by
+       FileServer.GET is given to it instead of being read by chunks in
+       Python. Only its Content-Length first bytes are sent (see
+       _LimitedFile).
+
+       e.g.: app.run(dfs.fileserver.sendfile)
+    """
+
+    def middleware(env, start_response):
+        result = wsgi(env, start_response)
+        f = web.ctx.get('dfs_file')
+        web.ctx.dfs_file = None
+        file_wrapper = env.get('wsgi.file_wrapper')
+
+        if f is None or file_wrapper is None:
+            return result
+
+        return file_wrapper(f, _config['chunk_size'])
+
+    return middleware
+
+
+def _stream(f, length=None):
+    """Yield the content of f chunk by chunk (at most length bytes if it
+       isn't None), and close it at the end.
+
+       Nothing is read before the second iteration because web.py peeps
+       at the first chunk to send the headers, and the sendfile middleware
+       may still decide to take f over at this point.
+    """
+
+    yield ''
+
+    if length is None:
+        length = float('inf')
+
+    chunk = f.read(min(length, _config['chunk_size']))
+
+    while chunk:
+        yield chunk
+        length -= len(chunk)
+        chunk = f.read(min(length, _config['chunk_size']))
+
+    f.close()
+
+
+class _LimitedFile:
+    """The length first bytes of the file f, for wsgi.file_wrapper: the
+       file may grow while it's being sent (e.g. appends), the bytes past
+       the Content-Length mustn't be sent. read() stops at length, and
+       the servers which use fileno() (sendfile) send at most the
+       Content-Length (PEP 3333).
+    """
+
+    def __init__(self, f, length):
+        self._f = f
+        self._left = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+
+        data = self._f.read(size)
+        self._left -= len(data)
+
+        return data
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def close(self):
+        self._f.close()
+
+
+def _etag(p, f=None, st=None):
+    """Return a strong ETag of the file p: the md5 of its content (see
+       _digest), so it's the same on all the replicas.
+    """
+
+    return '"%s"' % _digest(p, f, st)
+
+
+def _set_version_headers(p, f=None):
+    """Set the ETag and Last-Modified headers of the file p (f: p already
+       opened), return its os.stat and its ETag.
+    """
+
+    if f is None:
+        with open(p, 'rb') as f:
+            return _set_version_headers(p, f)
+
+    st = os.fstat(f.fileno())
+    etag = _etag(p, f, st)
+
+    web.header('ETag', etag)
+    web.header('Last-Modified', web.httpdate(
+        datetime.datetime.utcfromtimestamp(int(st.st_mtime))))
+
+    return st, etag
+
+
+def _not_modified(st, etag):
+    """Return True if the client already has the version of the file
+       whose os.stat is st and ETag is etag, according to the
+       If-None-Match header, or If-Modified-Since if there's no
+       If-None-Match.
+    """
+
+    env = web.ctx.env
+
+    if 'HTTP_IF_NONE_MATCH' in env:
+        etags = [e.strip() for e in env['HTTP_IF_NONE_MATCH'].split(',')]
+        return '*' in etags or etag in etags
+
+    if 'HTTP_IF_MODIFIED_SINCE' in env:
+        since = web.parsehttpdate(env['HTTP_IF_MODIFIED_SINCE'])
+        return (since is not None and
+                datetime.datetime.utcfromtimestamp(int(st.st_mtime)) <= since)
+
+    return False
+
+
+def _get_range(size):
+    """Return the (first, last) bytes requested by the Range header of the
+       request, or None if the whole file must be sent (no header, empty
+       file, or a multiple ranges request that we don't bother to handle).
+
+       Raise a '416 Requested Range Not Satisfiable' if the range doesn't
+       overlap the file.
+    """
+
+    header = web.ctx.env.get('HTTP_RANGE', '')
+
+    if not header.startswith('bytes=') or ',' in header or size == 0:
+        return None
+
+    start, _, end = header[len('bytes='):].partition('-')
+
+    try:
+        if not start:
+            # suffix: the last end bytes
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+
+    if start > end or start >= size:
+        raise web.webapi.HTTPError('416 Requested Range Not Satisfiable',
+                                   {'Content-Range': 'bytes */%d' % size})
+
+    return start, end
+
+
+def _receive(p, digest=True):
+    """Write the body of the request to the path p, by chunks, in a
+       temporary file which atomically replaces p at the end.
+
+       digest: if True, keep the md5 of the new p (see _md5).
+    """
+
+    length = web.intget(web.ctx.env.get('CONTENT_LENGTH'), 0)
+    rfile = web.ctx.env['wsgi.input']
+    md5 = hashlib.md5()
+
+    # same directory → same filesystem, so the rename is atomic
+    fd, tmp = tempfile.mkstemp(prefix='.dfs-', dir=os.path.dirname(p))
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while length > 0:
+                chunk = rfile.read(min(length, _config['chunk_size']))
+
+                if not chunk:
+                    raise IOError('Connection closed before the end of '
+                                  'the data (%s).' % p)
+
+                f.write(chunk)
+                md5.update(chunk)
+                length -= len(chunk)
+
+        # the rename keeps the inode, size & mtime
+        st = os.stat(tmp)
+
+        if os.path.exists(p):
+            shutil.copymode(p, tmp)
+        else:
+            os.chmod(tmp, 0644)
+
+        # see _fetch
+        with _append_locks[hash(p) % len(_append_locks)]:
+            os.rename(tmp, p)
+
+    except:
+        os.unlink(tmp)
+        raise
+
+    if digest:
+        _keep_md5(p, st, md5)
+
+
+def _patch(p, length):
+    """Apply the records in the body of the request (see FileServer.PATCH)
+       to a copy of p, truncate it to length bytes and rename it over p.
+    """
+
+    remaining = web.intget(web.ctx.env.get('CONTENT_LENGTH'), 0)
+    rfile = web.ctx.env['wsgi.input']
+
+    fd, tmp = tempfile.mkstemp(prefix='.dfs-', dir=os.path.dirname(p))
+
+    try:
+        with os.fdopen(fd, 'r+b') as f:
+            with open(p, 'rb') as src:
+                shutil.copyfileobj(src, f, _config['chunk_size'])
+
+            while remaining > 0:
+                line = rfile.readline(min(remaining, 64))
+                remaining -= len(line)
+
+                try:
+                    offset, size = [int(n) for n in line.split()]
+                except ValueError:
+                    raise web.badrequest()
+
+                f.seek(offset)
+
+                while size > 0:
+                    chunk = rfile.read(min(size, _config['chunk_size']))
+
+                    if not chunk:
+                        raise IOError('Connection closed before the end of '
+                                      'the data (%s).' % p)
+
+                    f.write(chunk)
+                    size -= len(chunk)
+                    remaining -= len(chunk)
+
+            f.truncate(length)
+
+        shutil.copymode(p, tmp)
+
+        # see _fetch
+        with _append_locks[hash(p) % len(_append_locks)]:
+            os.rename(tmp, p)
+
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def _append(p, data, offset=None):
+    """Append the content of the file data at the end of p (created if
+       needed), return the offset where it was written.
+
+       If offset isn't None, p must end there: wait at most append_wait
+       seconds for the appends which come before (they may be forwarded
+       after this one, see _replicate), then raise a '409 Conflict' with
+       the size of p if it doesn't (this server missed appends, or others
+       were sent to it).
+    """
+
+    cond = _append_locks[hash(p) % len(_append_locks)]
+    deadline = time.time() + _config['append_wait']
+
+    with cond:
+        while offset is not None and _getsize(p) < offset and\
+                time.time() < deadline:
+            cond.wait(deadline - time.time())
+
+        if offset is not None and _getsize(p) != offset:
+            # see _append_conflict
+            raise web.conflict(str(_getsize(p)))
+
+        with open(p, 'ab') as f, open(data, 'rb') as src:
+            f.seek(0, 2)
+            offset = f.tell()
+            # the md5 of p goes on with the data, if it's known
+            md5 = _cached_md5(p, os.fstat(f.fileno()))
+
+            if md5 is not None:
+                md5 = md5.copy()
+
+            for chunk in iter(lambda: src.read(_config['chunk_size']), ''):
+                f.write(chunk)
+
+                if md5 is not None:
+                    md5.update(chunk)
+
+            f.flush()
+
+            if md5 is not None:
+                _keep_md5(p, os.fstat(f.fileno()), md5)
+
+        cond.notify_all()
+
+    return offset
+
+
+def _getsize(p):
+    """Return the size of the file p, 0 if it doesn't exist."""
+
+    try:
+        return os.path.getsize(p)
+    except OSError:
+        return 0
+
+
+def _checksums(p, block_size):
+    """Return utils.block_checksums of the file p, the result is kept
+       until the file is modified (i.e. it's size, mtime or inode changes,
+       PUT & PATCH rename a new file over the former one).
+    """
+
+    st = os.stat(p)
+    key = (p, block_size)
+    version = (st.st_ino, st.st_size, st.st_mtime)
+
+    with _checksums_lock:
+        if key in _checksums_cache:
+            cached_version, checksums = _checksums_cache.pop(key)
+
+            if cached_version == version:
+                # move it at the end, the most recently used one
+                _checksums_cache[key] = (version, checksums)
+                return checksums
+
+    with open(p, 'rb') as f:
+        checksums = utils.block_checksums(f, block_size)
+
+    with _checksums_lock:
+        _checksums_cache[key] = (version, checksums)
+
+        while len(_checksums_cache) > _config['checksums_cache_size']:
+            _checksums_cache.popitem(last=False)
+
+    return checksums
+
+
+def _get_checksums(p, block_size):
+    """Return the checksums of p as a text: the first line is the md5 of
+       the whole file, then each line is the md5 of a block of block_size
+       bytes.
+    """
+
+    digest, sums = _checksums(p, block_size)
+    return '\n'.join([digest] + sums)
+
+
 def _get_local_path(filepath):
     """Convert the filepath uri to an absolute path in the FS."""
 
     return os.path.join(os.getcwd(), _config['fsroot'], filepath[1:])
 
 
-def _raise_if_locked(filepath):
+def _makedirs(dirpath):
+    """Create dirpath and its parents if they don't exist (yet, another
+       request may create them at the same time).
+    """
+
+    try:
+        os.makedirs(dirpath)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(dirpath):
+            raise
+
+
+def _replicate(filepath, method, p=None, offset=None):
+    """Forward the write just done on filepath to the next server of the
+       replica set of its directory (chain replication: this server
+       forwards it to the following one, and so on, back to the begining
+       of the replica set, since the clients write to any of its servers,
+       see dfs.client._replicas).
+
+       The servers which are down (or refuse the write) are skipped, and
+       reported to the nameserver which has them resynced (see
+       _report_missed). The X-DFS-Replicated header holds the servers
+       already written, so a write never goes twice through the same
+       server.
+
+       method: PUT, POST (append) or DELETE, the query string of the
+               request is forwarded too
+       p: the local file to send (for PUT & POST)
+       offset: where the data of a POST was appended, the next server
+               must append it at the same offset (see FileServer.POST
+               and _append_conflict)
+    """
+
+    if _is_chunk(filepath):
+        return
+
+    replicated = web.ctx.env.get('HTTP_X_DFS_REPLICATED')
+    done = set(utils.get_replicas(replicated))
+    done.add(_config['srv'])
+
+    try:
+        host, port = utils.get_host_port(_config['nameserver'])
+        replicas = utils.get_replicas(utils.get_server(filepath, host, port))
+    except Exception as e:
+        logging.warning('Unable to replicate %s: %s', filepath, e)
+        return
+
+    if _config['srv'] not in replicas:
+        return
+
+    url = filepath + web.ctx.query
+
+    if offset is not None:
+        url = filepath + '?' + urllib.urlencode(
+                dict(web.input(_method='get'), offset=offset))
+
+    n = replicas.index(_config['srv'])
+    successors = replicas[n + 1:] + replicas[:n]
+
+    for srv in successors:
+        if srv in done:
+            continue
+
+        headers = {'X-DFS-Replicated': ','.join(sorted(done))}
+        body = None
+
+        try:
+            if p is not None:
+                body = open(p, 'rb')
+                headers['Content-Length'] = str(os.fstat(body.fileno()).st_size)
+
+            host, port = utils.get_host_port(srv)
+
+            with utils.pool.connection(host, port) as con:
+                response = utils.request(con, method, url, body, headers)
+                data = response.read()
+
+        except (IOError, socket.error, httplib.HTTPException) as e:
+            logging.warning('Unable to replicate %s on %s: %s', filepath,
+                            srv, e)
+            _report_missed(srv)
+            continue
+        finally:
+            if body is not None:
+                body.close()
+
+        # 204: there was nothing to delete
+        if response.status in (200, 204):
+            return
+
+        if response.status == 409 and offset is not None:
+            # the size of its file is in the body
+            _append_conflict(filepath, srv, url, p, offset,
+                             web.intget(data, -1))
+            return
+
+        logging.warning('Unable to replicate %s on %s (%d).', filepath,
+                        srv, response.status)
+
+        if response.status != 406:
+            # 406: it doesn't serve the directory anymore
+            _report_missed(srv)
+
+
+def _report_missed(srv):
+    """Tell the nameserver that srv missed a write, so it resyncs its
+       directories (see NameServer.POST and _heartbeat).
+    """
+
+    data = urllib.urlencode({'missed': srv})
+    host, port = utils.get_host_port(_config['nameserver'])
+
+    try:
+        with utils.pool.connection(host, port) as con:
+            utils.request(con, 'POST', '/', data,
+                    {'Content-Type': 'application/x-www-form-urlencoded'}
+                    ).read()
+    except (socket.error, httplib.HTTPException) as e:
+        logging.warning('Unable to report that %s missed a write: %s', srv,
+                        e)
+
+
+def _append_conflict(filepath, srv, url, p, offset, size):
+    """srv couldn't append the data p this server appended at offset to
+       filepath (see _replicate), because its file is size bytes long.
+
+       If srv missed appends (e.g. it was down), it gets the whole file
+       (see _replicate_whole). Otherwise, unless srv already got the whole
+       file, this server missed appends (e.g. they were sent to srv while
+       it was down): it takes the file of srv (see _catch_up), without the
+       data just appended, and raises a '409 Conflict' (the client appends
+       it again, see dfs.client._append).
+    """
+
+    if size < offset:
+        logging.warning('%s missed appends to %s, sending it the whole'
+                        ' file.', srv, filepath)
+        _replicate_whole(filepath)
+        return
+
+    if _has_data(srv, url, p, offset):
+        # it got our whole file meanwhile (see _replicate_whole)
+        return
+
+    logging.warning('%s has appends to %s this server missed, fetching'
+                    ' the whole file.', srv, filepath)
+    _catch_up(filepath, srv, url)
+
+    raise web.conflict(str(_getsize(_get_local_path(filepath))))
+
+
+def _replicate_whole(filepath):
+    """Send the whole local filepath to the next servers of its replica
+       set (see _replicate), a copy of it: it may be appended meanwhile.
+    """
+
+    p = _get_local_path(filepath)
+    fd, tmp = tempfile.mkstemp(prefix='.dfs-', dir=os.path.dirname(p))
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with _append_locks[hash(p) % len(_append_locks)]:
+                with open(p, 'rb') as src:
+                    shutil.copyfileobj(src, f, _config['chunk_size'])
+
+        _replicate(filepath, 'PUT', tmp)
+    finally:
+        os.unlink(tmp)
+
+
+def _has_data(srv, url, p, offset):
+    """Return True if the file of srv (GET url) holds the content of
+       the file p at offset.
+    """
+
+    length = os.path.getsize(p)
+    headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+
+    with open(p, 'rb') as f:
+        with utils.pool.connection(*utils.get_host_port(srv)) as con:
+            response = utils.request(con, 'GET', url, headers=headers)
+            same = response.status == 206
+
+            while length > 0:
+                chunk = response.read(min(length, _config['chunk_size']))
+                same = same and chunk == f.read(len(chunk))
+                length -= len(chunk)
+
+                if not chunk:
+                    same = False
+                    break
+
+            response.read()
+
+    return same
+
+
+def _catch_up(filepath, srv, url):
+    """Replace the local filepath by the one of srv (GET url), no data
+       is appended to it meanwhile.
+    """
+
+    p = _get_local_path(filepath)
+    fd, tmp = tempfile.mkstemp(prefix='.dfs-', dir=os.path.dirname(p))
+
+    try:
+        with _append_locks[hash(p) % len(_append_locks)]:
+            with os.fdopen(fd, 'wb') as f:
+                with utils.pool.connection(*utils.get_host_port(srv)) as con:
+                    response = utils.request(con, 'GET', url)
+
+                    if response.status == 200:
+                        shutil.copyfileobj(response, f, _config['chunk_size'])
+                    else:
+                        response.read()
+
+            if response.status != 200:
+                raise IOError('Error (%d) while fetching %s from %s.'
+                              % (response.status, filepath, srv))
+
+            shutil.copymode(p, tmp)
+            os.rename(tmp, p)
+
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def _raise_if_locked(filepath, write=False):
     """Raise a 401 unauthorized it the filepath is locked, and the
        appropriate locked wasn't given in the request.
+
+       write: if True, the request modifies the file, so it's also locked
+              by the shared leases (which can't be used to write it).
     """
 
-    i = web.input()
+    if _is_chunk(filepath):
+        return
 
-    host, port = utils.get_host_port(_config['lockserver'])
-    if utils.is_locked(filepath, host, port, i.get('lock_id', None)):
+    if not write and 'HTTP_X_DFS_REPLICATED' in web.ctx.env:
+        # another replica (see _fetch)
+        return
+
+    # only look at the query string, the body may be a (big) file
+    i = web.input(_method='get')
+    lock_id = i.get('lock_id', None)
+
+    host, port = utils.get_lockserver(filepath, _config['lockserver'])
+    locks = _locks[host, port]
+
+    if locks.synced:
+        # no need to ask the lockserver, except for the locked files (the
+        # lock may have just been revoked), the writes without a lock (the
+        # copy may lag behind a new lock, and the shared leases aren't in
+        # it) and the tokens we can't check (expired, no secret, or a lock
+        # we don't know yet)
+        holder = locks.locks.get(filepath)
+
+        if holder is None and not write:
+            # the reads only need the file not to be locked (whatever
+            # their shared lease is)
+            return
+
+        if lock_id is not None and _config['secret'] is not None:
+            token_id = utils.check_lock_token(_config['secret'], filepath,
+                                              lock_id)
+
+            if token_id is not None and token_id == holder:
+                # the lockserver would have renewed it, see _renew_forever
+                with _renewals_lock:
+                    _renewals[filepath] = lock_id
+
+                return
+
+    if utils.is_locked(filepath, host, port, lock_id, write):
         raise web.unauthorized()
 
 
+def _follow_locks(host, port):
+    """Keep the copy of the locks of the lockserver host:port up to date,
+       by long polling it. If it can't hold our request (see
+       lockserver._following), the copy isn't trusted until the next
+       try, locks_retry seconds later.
+    """
+
+    while True:
+        try:
+            _locks[host, port].sync(host, port, _config['locks_wait'])
+        except Exception as e:
+            logging.warning('Unable to sync the locks: %s', e)
+            time.sleep(_config['locks_retry'])
+
+
+def _renew_forever():
+    """Renew the locks used by the writes we accepted without the
+       lockserver (see _raise_if_locked) every renew_interval seconds, in
+       one request per lockserver.
+    """
+
+    global _renewals
+
+    while True:
+        time.sleep(_config['renew_interval'])
+
+        with _renewals_lock:
+            renewals, _renewals = _renewals, {}
+
+        if not renewals:
+            continue
+
+        try:
+            utils.renew_locks(renewals.items(), _config['lockserver'])
+        except Exception as e:
+            logging.warning('Unable to renew the locks: %s', e)
+
+
 def _raise_if_dir_or_not_servable(filepath):
     """Raise a 406 notacceptable if the filepath isn't supposed to be
-       served, or if it's a directory.
+       served (it isn't below one of our directories, nor a chunk), or if
+       it's a directory.
     """
 
     p = _get_local_path(filepath)
 
-    if (os.path.dirname(filepath) not in _config['directories'] or
-            os.path.isdir(p)):
+    if (os.path.normpath(filepath) != filepath or os.path.isdir(p) or
+            _directories.resolve(filepath)[0] is None and
+            not _is_chunk(filepath)):
         # request a file which this server isn't supposed to serve!
         raise web.notacceptable()
 
 
+def _is_chunk(filepath):
+    """Return True if filepath is a chunk (see FileServer)."""
+
+    return filepath.startswith('/.chunks/')
+
+
+def _raise_if_dirty(filepath):
+    """Raise a 503 Service Unavailable if the directory of filepath is
+       being resynced (see _resync), unless another replica asks.
+
+       The writes of the clients are refused too: if this server was the
+       first to append to a file, _fetch could replace it by the file of
+       a replica the append hasn't reached yet.
+    """
+
+    if _is_chunk(filepath) or 'HTTP_X_DFS_REPLICATED' in web.ctx.env:
+        return
+
+    if _directories.resolve(filepath)[0] in _dirty:
+        raise web.webapi.HTTPError('503 Service Unavailable',
+                                   {'Content-Type': 'text/plain'})
+
+
+def _get_list(dirpath):
+    """Return the files of the directory dirpath (one of ours) and their
+       md5, one 'md5 filepath' per line (see _resync), or a '503 Service
+       Unavailable' if it's being resynced.
+    """
+
+    if dirpath not in _config['directories']:
+        raise web.notacceptable()
+
+    if dirpath in _dirty:
+        raise web.webapi.HTTPError('503 Service Unavailable',
+                                   {'Content-Type': 'text/plain'})
+
+    lines = []
+
+    for filepath, p in _walk(dirpath):
+        try:
+            lines.append('%s %s' % (_digest(p), filepath))
+        except (IOError, OSError):
+            # removed meanwhile
+            continue
+
+    return '\n'.join(lines)
+
+
+def _walk(dirpath):
+    """Yield the (filepath, local path) of the files of the directory
+       dirpath (not those of its subdirectories served as other
+       directories).
+    """
+
+    root = os.path.join(os.getcwd(), _config['fsroot'])
+
+    for d, _, filenames in os.walk(_get_local_path(dirpath)):
+        for name in filenames:
+            if name.startswith('.dfs-'):
+                # a temporary file
+                continue
+
+            p = os.path.join(d, name)
+            filepath = '/' + os.path.relpath(p, root)
+
+            if _directories.resolve(filepath)[0] == dirpath:
+                yield filepath, p
+
+
+def _digest(p, f=None, st=None):
+    """Return the md5 of the file p as an hexadecimal string, see _md5."""
+
+    return _md5(p, f, st).hexdigest()
+
+
+def _md5(p, f=None, st=None):
+    """Return the md5 (a hashlib object, to copy before updating it) of
+       the file p, the result is kept until the file is modified (see
+       _checksums), the writes compute it as they go (see _receive and
+       _append).
+
+       f: p already opened (its position is kept)
+       st: the os.fstat of f, only st_size bytes are read (the file may
+           be appended meanwhile)
+    """
+
+    if f is None:
+        with open(p, 'rb') as f:
+            return _md5(p, f, st)
+
+    if st is None:
+        st = os.fstat(f.fileno())
+
+    md5 = _cached_md5(p, st)
+
+    if md5 is not None:
+        return md5
+
+    md5 = hashlib.md5()
+    position = f.tell()
+    remaining = st.st_size
+    f.seek(0)
+
+    while remaining > 0:
+        chunk = f.read(min(remaining, _config['chunk_size']))
+
+        if not chunk:
+            break
+
+        md5.update(chunk)
+        remaining -= len(chunk)
+
+    f.seek(position)
+    _keep_md5(p, st, md5)
+
+    return md5
+
+
+def _cached_md5(p, st):
+    """Return the md5 of the file p if it's known for the version whose
+       os.stat is st, or None.
+    """
+
+    version = (st.st_ino, st.st_size, st.st_mtime)
+
+    with _digests_lock:
+        cached = _digests_cache.pop(p, None)
+
+        if cached is None or cached[0] != version:
+            return None
+
+        # move it at the end, the most recently used one
+        _digests_cache[p] = cached
+        return cached[1]
+
+
+def _keep_md5(p, st, md5):
+    """Keep md5, the md5 of the version of the file p whose os.stat is st
+       (see _md5).
+    """
+
+    version = (st.st_ino, st.st_size, st.st_mtime)
+
+    with _digests_lock:
+        _digests_cache[p] = (version, md5)
+
+        while len(_digests_cache) > _config['digests_cache_size']:
+            _digests_cache.popitem(last=False)
+
+
+def _mark_dirty(dirpaths):
+    """The directories dirpaths must be resynced (see _resync_forever)."""
+
+    with _resync_cond:
+        for dirpath in dirpaths:
+            logging.info('%s must be resynced.', dirpath)
+            _dirty[dirpath] = time.time()
+
+        _resync_cond.notify()
+
+
+def _resync_forever():
+    """Resync the dirty directories (see _mark_dirty), those which can't
+       be resynced are retried every heartbeat_interval seconds.
+    """
+
+    while True:
+        with _resync_cond:
+            while not _dirty:
+                _resync_cond.wait()
+
+            dirty = _dirty.items()
+
+        failed = False
+
+        for dirpath, marked in dirty:
+            try:
+                _resync(dirpath, marked)
+            except Exception as e:
+                logging.warning('Unable to resync %s: %s', dirpath, e)
+                failed = True
+                continue
+
+            with _resync_cond:
+                if _dirty.get(dirpath) == marked:
+                    # not marked again meanwhile
+                    del _dirty[dirpath]
+                    logging.info('%s is resynced.', dirpath)
+
+        if failed:
+            time.sleep(_config['heartbeat_interval'])
+
+
+def _resync(dirpath, marked):
+    """Make the directory dirpath, marked dirty at the time marked, the
+       same as on another replica which isn't dirty: fetch the files
+       which differ (see _fetch), and remove those the replica doesn't
+       have and which weren't modified since marked.
+
+       If no other replica can be reached (or they're all dirty too, e.g.
+       they're all starting), the directory is kept as is.
+    """
+
+    host, port = utils.get_host_port(_config['nameserver'])
+    # the directory itself is below dirpath + '/'
+    replicas = utils.get_replicas(utils.get_server(dirpath + '/', host,
+                                                   port))
+
+    for srv in replicas:
+        if srv == _config['srv']:
+            continue
+
+        try:
+            with utils.pool.connection(*utils.get_host_port(srv)) as con:
+                response = utils.request(con, 'GET', dirpath + '?list=1',
+                        headers={'X-DFS-Replicated': _config['srv']})
+                data = response.read()
+        except (socket.error, httplib.HTTPException) as e:
+            logging.warning('Unable to list %s on %s: %s', dirpath, srv, e)
+            continue
+
+        if response.status == 200:
+            break
+    else:
+        logging.info('No replica to resync %s from.', dirpath)
+        return
+
+    logging.info('Resyncing %s from %s.', dirpath, srv)
+    files = set()
+
+    for line in data.split('\n'):
+        if not line:
+            continue
+
+        digest, filepath = line.split(' ', 1)
+        files.add(filepath)
+        p = _get_local_path(filepath)
+
+        if not os.path.exists(p) or _digest(p) != digest:
+            _fetch(filepath, srv)
+
+    for filepath, p in _walk(dirpath):
+        if filepath in files:
+            continue
+
+        with _append_locks[hash(p) % len(_append_locks)]:
+            if os.path.getmtime(p) < marked:
+                logging.info('Removing %s, removed on %s.', filepath, srv)
+                os.unlink(p)
+
+
+def _fetch(filepath, srv):
+    """Replace the local filepath by the one of srv, unless it's modified
+       meanwhile (a write forwarded by another replica, see _replicate,
+       which is newer).
+    """
+
+    p = _get_local_path(filepath)
+    _makedirs(os.path.dirname(p))
+    version = _version(p)
+
+    fd, tmp = tempfile.mkstemp(prefix='.dfs-', dir=os.path.dirname(p))
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with utils.pool.connection(*utils.get_host_port(srv)) as con:
+                response = utils.request(con, 'GET', filepath,
+                        headers={'X-DFS-Replicated': _config['srv']})
+
+                if response.status == 200:
+                    shutil.copyfileobj(response, f, _config['chunk_size'])
+                else:
+                    response.read()
+
+        if response.status not in (200, 204):
+            raise IOError('Error (%d) while fetching %s from %s.'
+                          % (response.status, filepath, srv))
+
+        with _append_locks[hash(p) % len(_append_locks)]:
+            if _version(p) != version:
+                logging.info('%s was modified while being resynced.',
+                             filepath)
+            elif response.status == 204:
+                # removed on srv meanwhile
+                if version is not None:
+                    os.unlink(p)
+            else:
+                os.chmod(tmp, 0644)
+                os.rename(tmp, p)
+                return
+
+        os.unlink(tmp)
+
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def _version(p):
+    """Return the (inode, size, mtime) of the file p, None if it doesn't
+       exist.
+    """
+
+    try:
+        st = os.stat(p)
+    except OSError:
+        return None
+
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
 def _raise_if_not_exists(filepath):
     """Raise a 204 No Content if the file doesn't exists."""
 
@@ -117,30 +1351,186 @@ def _raise_if_not_exists(filepath):
                                    {'Content-Type': 'plain/text'})
 
 
+class _Load:
+    """Load of the fileserver, reported to the nameserver by the
+       heartbeats (see _heartbeat).
+    """
+
+    def __init__(self):
+        # number of requests being handled
+        self.active = 0
+        # bytes received & sent since the last call of stats
+        self.bytes = 0
+        self.since = time.time()
+        self._lock = threading.Lock()
+
+    def begin(self, length):
+        """A request of length bytes is being handled."""
+
+        with self._lock:
+            self.active += 1
+            self.bytes += length
+
+    def end(self, length):
+        """A request was handled, its response is length bytes long."""
+
+        with self._lock:
+            self.active -= 1
+            self.bytes += length
+
+    def stats(self):
+        """Return the number of active requests, the bytes/s received &
+           sent since the last call, and the bytes free on the disk.
+        """
+
+        st = os.statvfs(os.path.join(os.getcwd(), _config['fsroot']))
+
+        with self._lock:
+            now = time.time()
+            rate = self.bytes / max(now - self.since, 1)
+            self.bytes, self.since = 0, now
+
+            return self.active, int(rate), st.f_bavail * st.f_frsize
+
+
 def _init_file_server():
-    """Just notify the nameserver about which directories we serve."""
+    """Notify the nameserver about which directories we serve, then keep
+       doing it every heartbeat_interval seconds, so it knows we're alive.
+    """
+
+    _heartbeat()
+
+    thread = threading.Thread(target=_heartbeat_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def _heartbeat():
+    """Send the directories we serve and our load (see _Load.stats) to the
+       nameserver, and resync them if it says we missed writes (we were
+       considered dead, or a write couldn't be replicated here).
+    """
+
+    active, rate, free = _load.stats()
+    data = urllib.urlencode({
+        'srv': _config['srv'],
+        'dirs': '\n'.join(sorted(_config['directories'])),
+        'active': active,
+        'rate': rate,
+        'free': free,
+        })
 
     host, port = utils.get_host_port(_config['nameserver'])
-    with closing(HTTPConnection(host, port)) as con:
-        data = 'srv=%s&dirs=%s' % (_config['srv'],
-                                '\n'.join(_config['directories']),)
-        con.request('POST', '/', data)
+
+    with utils.pool.connection(host, port) as con:
+        answer = utils.request(con, 'POST', '/', data,
+                {'Content-Type': 'application/x-www-form-urlencoded'}).read()
+
+    if answer == 'RESYNC':
+        _mark_dirty(_config['directories'])
+
+
+def _heartbeat_forever():
+    """Call _heartbeat every heartbeat_interval seconds."""
+
+    while True:
+        time.sleep(_config['heartbeat_interval'])
+
+        try:
+            _heartbeat()
+        except Exception as e:
+            logging.warning('Unable to send a heartbeat: %s', e)
 
 
 _config = {
+        # 'host:port', or a list of them (see utils.get_lockserver)
         'lockserver': None,
         'nameserver': None,
         'directories': [],
         'fsroot': 'fs/',
         'srv': None,
+        'chunk_size': 64 * 1024,
+        'block_size': 64 * 1024,
+        'checksums_cache_size': 128,
+        'digests_cache_size': 4096,
+        # idle connections kept per server: each one holds a thread of
+        # that server until it drops it (web.py's has 10 threads), and all
+        # the fileservers talk to the same lockserver
+        'pool_size': 2,
+        'pool_idle_timeout': 30,
+        # shared with the lockserver, to check the locks without it
+        'secret': None,
+        # seconds a request for the changes of the locks waits for them,
+        # well below the lock_lifetime of the lockserver
+        'locks_wait': 10,
+        'locks_retry': 1,
+        # seconds between the renewals of the locks checked without the
+        # lockserver, must be less than its lock_lifetime
+        'renew_interval': 5,
+        # seconds between two heartbeats, must be less than the
+        # server_timeout of the nameserver
+        'heartbeat_interval': 5,
+        # seconds an append forwarded by another replica waits for the
+        # appends which come before it (see _append)
+        'append_wait': 10,
         }
 
 logging.info('Loading config file fileserver.dfs.json.')
 utils.load_config(_config, 'fileserver.dfs.json')
+utils.pool.max_size = _config['pool_size']
+utils.pool.idle_timeout = _config['pool_idle_timeout']
+
+# to know if we serve a file (i.e. one of its parent directories) in
+# O(depth of the file)
+_directories = utils.PathTrie()
+
+for dirpath in _config['directories']:
+    _directories.add(dirpath, True)
+
+_load = _Load()
+
+# (path, block_size) → ((inode, size, mtime), (digest, sums)) of the
+# recently used files
+_checksums_cache = collections.OrderedDict()
+_checksums_lock = threading.Lock()
+
+# path → ((inode, size, mtime), md5) of the recently used files, see
+# _md5
+_digests_cache = collections.OrderedDict()
+_digests_lock = threading.Lock()
+
+# the appends to a file are serialized by one of these locks (picked by
+# the hash of its path), see _append
+_append_locks = [threading.Condition() for _ in xrange(64)]
+
+# dirpath → when it was marked dirty, for the directories to resync (all
+# of them when the server starts, it may have missed writes), see
+# _mark_dirty
+_dirty = dict.fromkeys(_config['directories'], time.time())
+_resync_cond = threading.Condition()
+
+_resync_thread = threading.Thread(target=_resync_forever)
+_resync_thread.daemon = True
+_resync_thread.start()
+
+# (host, port) of a lockserver → copy of its locks, updated by
+# _follow_locks
+_locks = {}
+
+for host, port in utils.get_lockservers(_config['lockserver']):
+    _locks[host, port] = utils.LockMap()
+    thread = threading.Thread(target=_follow_locks, args=(host, port))
+    thread.daemon = True
+    thread.start()
+
+# filepath → lock token accepted by _raise_if_locked since the last
+# renewal, see _renew_forever
+_renewals = {}
+_renewals_lock = threading.Lock()
 
-# just to speed up the search to know if we can serve a file
-# O(n) → O(log n)
-_config['directories'] = set(_config['directories'])
+_renew_thread = threading.Thread(target=_renew_forever)
+_renew_thread.daemon = True
+_renew_thread.start()
 
 _init_file_server()
 
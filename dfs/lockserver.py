@@ -4,10 +4,15 @@ import atexit
 import collections
 import copy
 import datetime
+import heapq
+import json
 import logging
-import os.path
+import os
 import random
-import shelve
+import threading
+import time
+
+from contextlib import contextmanager
 
 import web
 
@@ -15,16 +20,155 @@ import utils
 
 Lock = collections.namedtuple('Lock', 'lock_id granted last_used')
 
+class WriteAheadLog:
+    """Append-only log of the changes made to the locks, one JSON record
+       per line, which makes the in-memory table durable (not the shared
+       leases, see _grant_shared_lease).
+
+       The records are fsync'ed by a background thread, all the records
+       appended during an fsync are synced together by the next one (group
+       commit), commit() waits until the records appended so far are
+       durable. When the log reaches max_records, compact() replaces it by
+       a snapshot of the table.
+    """
+
+    def __init__(self, path, snapshot_path, max_records):
+        """path: the log file
+           snapshot_path: the file holding the last snapshot
+           max_records: number of records after which the log should be
+                        compacted
+        """
+
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.max_records = max_records
+        self.records = 0
+        self.appended = 0
+        self.synced = 0
+        self._f = None
+        self._cond = threading.Condition()
+
+    def replay(self):
+        """Yield the records of the snapshot then the ones of the log, and
+           open the log for appending (a last record partially written
+           because of a crash is dropped).
+        """
+
+        for record, _ in _read_records(self.snapshot_path):
+            yield record
+
+        end = 0
+
+        for record, end in _read_records(self.path):
+            self.records += 1
+            yield record
+
+        self._f = open(self.path, 'ab')
+        self._f.truncate(end)
+
+        thread = threading.Thread(target=self._sync_forever)
+        thread.daemon = True
+        thread.start()
+
+    def append(self, record):
+        """Append the record to the log (it's not durable until commit)."""
+
+        with self._cond:
+            self._f.write(json.dumps(record) + '\n')
+            self.records += 1
+            self.appended += 1
+            self._cond.notify_all()
+
+    def commit(self):
+        """Wait until all the records appended so far are on the disk."""
+
+        with self._cond:
+            target = self.appended
+
+            while self.synced < target:
+                self._cond.wait()
+
+    def compact(self, records):
+        """Replace the snapshot by records (the current state of the table)
+           and empty the log.
+        """
+
+        with self._cond:
+            tmp = self.snapshot_path + '.tmp'
+
+            with open(tmp, 'wb') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(tmp, self.snapshot_path)
+
+            # if we crash now the log is just replayed once again over the
+            # snapshot, which already contains its changes
+            self._f.flush()
+            self._f.truncate(0)
+            os.fsync(self._f.fileno())
+
+            self.records = 0
+            self.synced = self.appended
+            self._cond.notify_all()
+
+    def close(self):
+        """Sync the records and close the log."""
+
+        with self._cond:
+            if self._f is not None:
+                self._f.flush()
+                os.fsync(self._f.fileno())
+                self._f.close()
+                self._f = None
+
+    def _sync_forever(self):
+        """Fsync the log each time records are appended."""
+
+        while True:
+            with self._cond:
+                while self.synced == self.appended:
+                    self._cond.wait()
+
+                target = self.appended
+
+                if self._f is None:
+                    return
+
+                self._f.flush()
+                fileno = self._f.fileno()
+
+            # the lock isn't held so the next records can be appended
+            # meanwhile, they'll be synced by the next round
+            os.fsync(fileno)
+
+            with self._cond:
+                self.synced = max(self.synced, target)
+                self._cond.notify_all()
+
+
 class LockServer:
     """LockServer is responsible of handling locking on files."""
 
     def GET(self, filepath):
-        """If filepath == '/' just print all the dirs/lock.
+        """If filepath == '/' just print all the dirs/lock (or, with count
+           in the query, the number of live locks). The version of the
+           table is sent in the X-Locks-Version header, with lock_ids in
+           the query the table is sent as filepath=lock_id lines, and with
+           since=version the changes made after version are sent (see
+           _get_changes, wait=seconds allows to wait for them, if
+           max_followers requests already wait a '503 Service Unavailable'
+           is sent instead).
            Else if filepath isn't locked, return 200 OK (and no lock_id is
-           provided)
+           provided), with write in the query it mustn't have shared
+           leases either.
 
            Else If lock_id is in the request and filepath is locked with
-           this id:
+           this id (or has a shared lease with this id, without write in
+           the query):
                - return OK
                - update the last_used field
 
@@ -37,19 +181,52 @@ class LockServer:
         i = web.input()
 
         if filepath == '/':
-            # just a list of file=(granted, last_used)
-            return '\n'.join('%s=(%s, %s)' % (filepath,
-                   str(_locks[filepath].granted),
-                   str(_locks[filepath].last_used),)
-                   for filepath in sorted(_locks))
+            with _lock:
+                _sweep()
+
+                if 'count' in i:
+                    return str(sum(1 for _ in _all_locks()))
+
+                if 'since' in i:
+                    wait = min(web.intget(i.get('wait'), 0),
+                               _config['max_wait'])
+
+                    with _following(wait):
+                        return _get_changes(i['since'], wait)
+
+                web.header('X-Locks-Version', _version())
+
+                if 'lock_ids' in i:
+                    # same format as the changes
+                    return '\n'.join('+%s=%d' % (filepath, lock.lock_id)
+                                     for filepath, lock in _locks.items())
+
+                # just a list of file=(granted, last_used), and
+                # file=(granted, last_used, shared) for the shared leases
+                return '\n'.join('%s=(%s, %s%s)' % (filepath,
+                       str(lock.granted), str(lock.last_used),
+                       '' if _locks.get(filepath) is lock else ', shared')
+                       for filepath, lock in sorted(_all_locks()))
+
+        write = 'write' in i
+
+        if 'lock_id' in i and not write and\
+                _lock_id(filepath, i['lock_id']) in _leases.get(filepath, {}):
+            # see below
+            _update_lease(filepath, _lock_id(filepath, i['lock_id']))
+            return 'OK'
 
         elif filepath not in _locks and 'lock_id' not in i:
+            if write and filepath in _leases:
+                # the readers don't want the file to change under them
+                raise web.conflict()
+
             return 'OK'
 
         elif 'lock_id' in i:
             lock = _locks.get(filepath, -1)
             try:
-                if int(i['lock_id']) == lock.lock_id:
+                if _lock_id(filepath, i['lock_id']) == lock.lock_id:
                     # GET shouldn't be used to change state of server
                     # but it's a "good" idea to do it here, because
                     # when a file server will ask the LockServer if
@@ -78,6 +255,10 @@ class LockServer:
             # ok GET shouldn't change the state of server BUT in this
             # case it just update it because now we know that the lock
             _revoke_lock(filepath)
+
+            if write and filepath in _leases:
+                raise web.conflict()
+
             return 'OK'
 
         # already locked, or wrong lock_id
@@ -97,7 +278,20 @@ class LockServer:
 
            Else, if there's no lock on filepath, or an old lock,
            grant a new one (and revoke the older one if needed).
-           Return a 200 OK, with the lock id.
+           Return a 200 OK, with the lock id. If there are shared leases,
+           wait for their release (within the wait below, and at most
+           drain_wait seconds, see _wait_for_readers).
+
+           With shared in the query, grant a shared lease instead (see
+           _grant_shared_lease), the file can still be read but not
+           written until all the shared leases are released.
+
+           With wait=seconds in the query, wait at most this time for the
+           file to be unlocked instead of failing right away (the waiting
+           requests are served in FIFO order). Only max_waiters requests
+           can wait at the same time, the others get a '503 Service
+           Unavailable' (and retry, see utils.get_lock) so the threads
+           left can release & renew the locks they wait for.
 
            If a client want mutliples locks it should request them in one
            query (/) because if it ask in one request for each lock, it may
@@ -110,31 +304,89 @@ class LockServer:
         if filepath == '/':
             granted_locks = {}
 
-            for filepath in web.data().split('\n'):
-                if not filepath:
-                    # to allow an empty line at the end of the request data
-                    continue
+            with _lock:
+                for filepath in web.data().split('\n'):
+                    if not filepath:
+                        # to allow an empty line at the end of the request
+                        # data
+                        continue
+
+                    try:
+                        granted_locks[filepath] = _grant_new_lock(filepath)
+                    except Exception as e:
+                        logging.exception(e)
 
-                try:
-                    granted_locks[filepath] = _grant_new_lock(filepath)
-                except Exception as e:
-                    logging.exception(e)
+                        # revoking all previoulsy allocated locks
+                        for filepath in granted_locks:
+                            _revoke_lock(filepath)
 
-                    # revoking all previoulsy allocated locks
-                    for filepath in granted_locks:
-                        _revoke_lock(filepath)
+                        _wal.commit()
+                        raise web.unauthorized()
 
-                    raise web.unauthorized()
+            _wal.commit()
 
             # list of filename=lock_id
-            return '\n'.join('%s=%d' % (filepath, lock_id,)\
+            return '\n'.join('%s=%s' % (filepath, lock_id,)\
                     for filepath, lock_id in granted_locks.items())
 
-        try:
-            return _grant_new_lock(filepath)
-        except Exception as e:
-            logging.exception(e)
-            raise web.unauthorized()
+        i = web.input(_method='get')
+        # less than a lock lives: the locks waited for can be renewed
+        # (or expire) meanwhile
+        wait = min(web.intget(i.get('wait'), 0), _config['max_wait'],
+                   _config['lock_lifetime'] / 2)
+
+        with _waiting(wait) as wait:
+            try:
+                if 'shared' in i:
+                    lock_id = _grant_shared_lease(filepath, wait)
+                else:
+                    lock_id = _grant_new_lock(filepath, wait)
+            except Exception as e:
+                logging.exception(e)
+                raise web.unauthorized()
+
+        _wal.commit()
+        return lock_id
+
+
+    def PUT(self, filepath):
+        """If filepath == '/' renew all the locks (and shared leases), they
+           should be passed in the request data as two vars: filepaths and
+           lock_ids (see DELETE), i.e. update their last_used field.
+
+           Return the filepaths whose lock can't be renewed anymore
+           (revoked or expired), one per line.
+
+           Else, with idle in the query, the lock of filepath whose id is
+           the lock_id var is kept by its client without being used (see
+           dfs.client._LockKeeper), it's revoked as soon as another one
+           asks for filepath. Without idle, the lock is used again. A '409
+           Conflict' is sent if it was revoked (or expired).
+        """
+
+        web.header('Content-Type', 'text/plain; charset=UTF-8')
+
+        filepath = str(filepath)
+        i = web.input()
+
+        if filepath != '/' and 'lock_id' in i:
+            if not _set_idle(filepath, i['lock_id'], 'idle' in i):
+                raise web.conflict()
+
+            return 'OK'
+
+        if filepath != '/' or 'filepaths' not in i or 'lock_ids' not in i:
+            raise web.badrequest()
+
+        lost = []
+
+        with _lock:
+            for filepath, lock_id in zip(i['filepaths'].split('\n'),
+                                         i['lock_ids'].split('\n')):
+                if not _renew(filepath, lock_id):
+                    lost.append(filepath)
+
+        return '\n'.join(lost)
 
 
     def DELETE(self, filepath):
@@ -144,7 +396,8 @@ class LockServer:
            lock_ids).
 
            Otherwise revoke the lock associated to filename is revoked
-           it the lock_id vars match the actual lock_id.
+           it the lock_id vars match the actual lock_id (or the shared
+           lease with this id).
         """
 
         web.header('Content-Type', 'text/plain; charset=UTF-8')
@@ -158,10 +411,12 @@ class LockServer:
             if 'filepaths' not in i or 'lock_ids' not in i:
                 raise web.badrequest()
 
-            for filepath, lock_id in\
-                    zip(i['filepaths'].split('\n'), i['lock_ids'].split('\n')):
-                if _locks[filepath].lock_id == int(lock_id):
-                    _revoke_lock(filepath)
+            with _lock:
+                for filepath, lock_id in zip(i['filepaths'].split('\n'),
+                                             i['lock_ids'].split('\n')):
+                    _release(filepath, lock_id)
+
+            _wal.commit()
 
             # return OK even if some lock_ids were wrong
             # because they wanted to revoke them, so we don't need
@@ -169,12 +424,10 @@ class LockServer:
             # are no longer valid
             return 'OK'
 
-        elif filepath in _locks:
+        elif filepath in _locks or filepath in _leases:
             if 'lock_id' in i:
-                lock_id = i['lock_id']
-
-                if _locks[filepath].lock_id == int(lock_id):
-                    _revoke_lock(filepath)
+                _release(filepath, i['lock_id'])
+                _wal.commit()
 
                 # see above for why always ok
                 return 'OK'
@@ -186,39 +439,468 @@ class LockServer:
 
 
 def _lock_expired(filepath):
-    """Return True if the lock of filepath reach its expiration."""
+    """Return True if the lock of filepath reach its expiration (or was
+       already revoked), or if it's idle (see _set_idle): it can be
+       revoked for another client then.
+    """
+
+    lock = _locks.get(filepath)
+    return lock is None or _deadline(lock) < datetime.datetime.now() or\
+           filepath in _idle
+
+
+def _set_idle(filepath, token, idle):
+    """Mark the lock of filepath whose id is in token as idle, or as used
+       again (see PUT), return False if it's revoked or expired.
+    """
+
+    with _lock:
+        lock = _locks.get(filepath)
+
+        if lock is None or lock.lock_id != _lock_id(filepath, token) or\
+                _deadline(lock) < datetime.datetime.now():
+            return False
+
+        if idle:
+            _idle.add(filepath)
+            # the requests waiting for filepath can take it now
+            _feed.notify_all()
+        else:
+            _idle.discard(filepath)
+            _update_lock(filepath)
+
+        return True
+
+
+def _deadline(lock):
+    """Return when lock expires if it's not used until then."""
+
+    return lock.last_used +\
+            datetime.timedelta(seconds=_config['lock_lifetime'])
+
+
+def _push_deadline(filepath, lock):
+    """Add the deadline of lock to the heap of deadlines, the lock must be
+       held.
+
+       Updates of last_used don't push anything, the sweeper pushes the
+       lock back when it finds its deadline was postponed. Revoked locks
+       leave their entry in the heap, so it's rebuilt when it's mostly
+       made of those.
+    """
+
+    live = len(_locks)
+
+    if len(_deadlines) > 2 * live + 1024:
+        # only count the shared leases when the locks aren't enough
+        live += sum(len(leases) for leases in _leases.values())
+
+    if len(_deadlines) > 2 * live + 1024:
+        # lock is in the table so it's part of the new heap
+        _deadlines[:] = [(_deadline(l), f, l.lock_id)
+                         for f, l in _all_locks()]
+        heapq.heapify(_deadlines)
+        _sweeper.notify()
+        return
+
+    entry = (_deadline(lock), filepath, lock.lock_id)
+    heapq.heappush(_deadlines, entry)
+
+    if _deadlines[0] is entry:
+        # the sweeper may be waiting for a later deadline
+        _sweeper.notify()
+
+
+def _sweep():
+    """Revoke the expired locks, and return the time to wait until the
+       next deadline (None if there's no lock), the lock must be held.
+    """
+
+    while _deadlines:
+        deadline, filepath, lock_id = _deadlines[0]
+        lock = _find(filepath, lock_id)
+
+        if lock is None:
+            # revoked (and maybe granted again, with another entry)
+            heapq.heappop(_deadlines)
+            continue
+
+        now = datetime.datetime.now()
+
+        if deadline > now:
+            return (deadline - now).total_seconds()
+
+        if _deadline(lock) > now:
+            # used since it was pushed
+            heapq.heapreplace(_deadlines, (_deadline(lock), filepath, lock_id))
+            continue
+
+        heapq.heappop(_deadlines)
+        logging.info('Lock (%d) on %s expired.', lock_id, filepath)
+
+        if _locks.get(filepath) is lock:
+            _revoke_lock(filepath)
+        else:
+            _revoke_lease(filepath, lock_id)
+
+    return None
+
+
+def _sweep_forever():
+    """Revoke the locks as soon as they expire."""
+
+    with _sweeper:
+        while True:
+            _sweeper.wait(_sweep())
+
+
+@contextmanager
+def _waiting(wait):
+    """Count the request as a waiting one (see POST) while the block is
+       executed, raise a 503 Service Unavailable if there are already
+       max_waiters of them.
+    """
+
+    global _waiters
+
+    if not wait:
+        yield wait
+        return
+
+    with _lock:
+        if _waiters >= _config['max_waiters']:
+            raise web.webapi.HTTPError('503 Service Unavailable',
+                                       {'Content-Type': 'text/plain',
+                                        'Retry-After': '1'})
+
+        _waiters += 1
+
+    try:
+        yield wait
+    finally:
+        with _lock:
+            _waiters -= 1
+
+
+@contextmanager
+def _following(wait):
+    """Count the request as one waiting for the changes (see GET) while
+       the block is executed, raise a 503 Service Unavailable if there are
+       already max_followers of them (the fileserver checks its locks
+       with us until it can wait again, see fileserver._raise_if_locked).
+    """
+
+    global _followers
+
+    if not wait:
+        yield wait
+        return
 
-    last_used = _locks[filepath].last_used
-    return (datetime.datetime.now() - last_used).seconds\
-            > _config['lock_lifetime']
+    with _lock:
+        if _followers >= _config['max_followers']:
+            raise web.webapi.HTTPError('503 Service Unavailable',
+                                       {'Content-Type': 'text/plain',
+                                        'Retry-After': '1'})
 
+        _followers += 1
 
-def _grant_new_lock(filepath):
+    try:
+        yield wait
+    finally:
+        with _lock:
+            _followers -= 1
+
+
+def _grant_new_lock(filepath, wait=0):
     """Check if we can create a new lock, if possible:
        revoke the former lock if needed, create a new one
        and return it's id.
        Otherwise raise an Exception.
+
+       wait: seconds to wait for the release (or the expiration) of the
+             current lock, the requests waiting for the lock of a file
+             get it in FIFO order.
     """
 
-    if filepath in _locks:
-        if not _lock_expired(filepath):
-            # can't revoke the lock, it's still active
-            raise Exception('Unable to grant a new lock (%s).' % filepath)
+    with _lock:
+        deadline = time.time() + wait
+        queue = _queues.setdefault(filepath, collections.deque())
+        ticket = object()
+        queue.append(ticket)
+
+        try:
+            # _lock_expired is True if there's no lock
+            while queue[0] is not ticket or not _lock_expired(filepath):
+                if time.time() >= deadline:
+                    # can't revoke the lock, it's still active
+                    raise Exception('Unable to grant a new lock (%s).'
+                                    % filepath)
+
+                # notified by all the changes of the table
+                _feed.wait(deadline - time.time())
+
+            _revoke_lock(filepath)
+
+            if filepath in _leases:
+                _wait_for_readers(filepath, min(deadline - time.time(),
+                                                _config['drain_wait']))
+
+            return _new_lock(filepath)
+
+        finally:
+            queue.remove(ticket)
+
+            if not queue:
+                del _queues[filepath]
+
+            # the next one may get the lock now
+            _feed.notify_all()
+
+
+def _wait_for_readers(filepath, timeout):
+    """Wait at most timeout seconds for the release of the shared leases
+       of filepath, raise an Exception if they're still there, the lock
+       must be held.
+
+       The caller is in the queue of filepath, so no new shared lease is
+       granted meanwhile (the writers aren't starved by the readers).
+    """
+
+    deadline = time.time() + timeout
+
+    while filepath in _leases and time.time() < deadline:
+        _feed.wait(deadline - time.time())
+
+    if filepath in _leases:
+        raise Exception('Unable to grant a new lock (%s).' % filepath)
+
+
+def _grant_shared_lease(filepath, wait=0):
+    """Grant a new shared lease on filepath and return its id, raise an
+       Exception if filepath is locked, or if a writer waits for the
+       lock (see _grant_new_lock for wait).
+
+       The shared leases are only kept in memory, and they aren't in the
+       changes (the fileservers check the writes without a lock with us,
+       see fileserver._raise_if_locked), so they don't cost an fsync nor
+       a wake up of the fileservers. If the server restarts they're lost:
+       a writer may then replace a file being read, the readers notice it
+       when they renew their lease (see dfs.client._LockKeeper).
+    """
+
+    with _lock:
+        deadline = time.time() + wait
+
+        while filepath in _queues or not _lock_expired(filepath):
+            if time.time() >= deadline:
+                raise Exception('Unable to grant a shared lease (%s).'
+                                % filepath)
+
+            _feed.wait(deadline - time.time())
 
         _revoke_lock(filepath)
 
-    return _new_lock(filepath)
+        leases = _leases.setdefault(filepath, {})
+        lock_id = random.randrange(0, 32768)
+
+        while lock_id in leases:
+            lock_id = random.randrange(0, 32768)
+
+        logging.info('Granting shared lease (%d) on %s.', lock_id, filepath)
+        t = datetime.datetime.now()
+        leases[lock_id] = Lock(lock_id, t, t)
+        _push_deadline(filepath, leases[lock_id])
+
+        return _token(filepath, leases[lock_id])
 
 
 def _new_lock(filepath):
-    """Create a new lock for filepath, and return its id."""
+    """Create a new lock for filepath, and return its id (signed if
+       there's a secret, see _token).
+    """
 
     lock_id = random.randrange(0, 32768)
     logging.info('Granting lock (%d) on %s.', lock_id, filepath)
     t = datetime.datetime.now()
-    _locks[filepath] = Lock(lock_id, t, t)
 
-    return lock_id
+    with _lock:
+        _locks[filepath] = Lock(lock_id, t, t)
+        _idle.discard(filepath)
+        _log(_grant_record(filepath, _locks[filepath]))
+        _push_deadline(filepath, _locks[filepath])
+        _log_change('+%s=%d' % (filepath, lock_id))
+
+        return _token(filepath, _locks[filepath])
+
+
+def _token(filepath, lock):
+    """Return the lock_id of lock, as a token the fileservers can check by
+       themselves if there's a secret (see utils.lock_token).
+    """
+
+    if _config['secret'] is None:
+        return str(lock.lock_id)
+
+    # the lock can't expire before, even if it's never used
+    expiration = int(_timestamp(lock.granted)) + _config['lock_lifetime']
+
+    return utils.lock_token(_config['secret'], filepath, lock.lock_id,
+                            expiration)
+
+
+def _lock_id(filepath, token):
+    """Return the lock_id of a token (a lock_id if there's no secret), or
+       None if it isn't valid for filepath.
+    """
+
+    if _config['secret'] is None:
+        try:
+            return int(token)
+        except ValueError:
+            return None
+
+    # the fileservers only ask us for the expired tokens, the lock may
+    # still be alive
+    return utils.check_lock_token(_config['secret'], filepath, token,
+                                  expired_ok=True)
+
+
+def _version():
+    """Return the version of the table, the lock must be held."""
+
+    return '%s.%d' % (_incarnation, _seq)
+
+
+def _log_change(line):
+    """Record a change of the table (+filepath=lock_id or -filepath), and
+       wake up the requests waiting for it, the lock must be held.
+    """
+
+    global _seq
+
+    _seq += 1
+    _changes.append((_seq, line))
+    _feed.notify_all()
+
+
+def _get_changes(since, wait):
+    """Return the changes made after the version since, waiting at most
+       wait seconds if there's none yet, the lock must be held.
+
+       Raise a 410 gone if they aren't known anymore (too old, or since is
+       a version of a former run of the server).
+    """
+
+    incarnation, _, seq = since.partition('.')
+
+    try:
+        seq = int(seq)
+    except ValueError:
+        raise web.badrequest()
+
+    deadline = time.time() + wait
+
+    while incarnation == _incarnation and seq == _seq and\
+            time.time() < deadline:
+        _feed.wait(deadline - time.time())
+
+    if incarnation != _incarnation or seq > _seq or\
+            (_changes and seq < _changes[0][0] - 1):
+        raise web.gone()
+
+    web.header('X-Locks-Version', _version())
+
+    return '\n'.join(line for n, line in _changes if n > seq)
+
+
+def _find(filepath, lock_id):
+    """Return the lock, or the shared lease, lock_id of filepath (None if
+       there's none), the lock must be held.
+    """
+
+    lock = _locks.get(filepath)
+
+    if lock is not None and lock.lock_id == lock_id:
+        return lock
+
+    return _leases.get(filepath, {}).get(lock_id)
+
+
+def _all_locks():
+    """Yield the (filepath, lock) of all the locks and shared leases, the
+       lock must be held.
+    """
+
+    for item in _locks.items():
+        yield item
+
+    for filepath, leases in _leases.items():
+        for lock in leases.values():
+            yield filepath, lock
+
+
+def _release(filepath, token):
+    """Revoke the lock or the shared lease of filepath whose id is in
+       token, if there's one.
+    """
+
+    with _lock:
+        lock_id = _lock_id(filepath, token)
+        lock = _locks.get(filepath)
+
+        if lock is not None and lock.lock_id == lock_id:
+            _revoke_lock(filepath)
+        elif lock_id in _leases.get(filepath, {}):
+            _revoke_lease(filepath, lock_id)
+
+
+def _renew(filepath, token):
+    """Update the last_used field of the lock or the shared lease of
+       filepath whose id is in token, return False if there's none.
+    """
+
+    with _lock:
+        lock = _find(filepath, _lock_id(filepath, token))
+
+        if lock is None or _deadline(lock) < datetime.datetime.now():
+            return False
+
+        if _locks.get(filepath) is lock:
+            _update_lock(filepath)
+        else:
+            _update_lease(filepath, lock.lock_id)
+
+        return True
+
+
+def _update_lease(filepath, lock_id):
+    """Update the last_used field of the shared lease lock_id to now."""
+
+    t = datetime.datetime.now()
+
+    with _lock:
+        leases = _leases.get(filepath, {})
+
+        if lock_id in leases:
+            leases[lock_id] = leases[lock_id]._replace(last_used=t)
+
+
+def _revoke_lease(filepath, lock_id):
+    """Revoke the shared lease lock_id of filepath."""
+
+    with _lock:
+        leases = _leases.get(filepath, {})
+
+        if lock_id in leases:
+            logging.info('Revoking shared lease (%d) on %s.', lock_id,
+                         filepath)
+            del leases[lock_id]
+
+            if not leases:
+                del _leases[filepath]
+
+            # the writers waiting for the readers, see _wait_for_readers
+            _feed.notify_all()
 
 
 def _update_lock(filepath):
@@ -226,30 +908,166 @@ def _update_lock(filepath):
 
     t = datetime.datetime.now()
 
-    logging.info('Update lock on %s from %s to %s.',
-                 filepath, _locks[filepath].last_used, t)
+    with _lock:
+        if filepath not in _locks:
+            return
+
+        logging.info('Update lock on %s from %s to %s.',
+                     filepath, _locks[filepath].last_used, t)
 
-    l = _locks[filepath]
-    l = Lock(l.lock_id, l.granted, t)
-    _locks[filepath] = l
+        l = _locks[filepath]
+        l = Lock(l.lock_id, l.granted, t)
+        _locks[filepath] = l
+        _log(['U', filepath, _timestamp(t)])
 
 
 def _revoke_lock(filepath):
     """Revoke the lock associated to filepath."""
 
-    if filepath in _locks:
-        logging.info('Revoking lock on %s.', filepath)
-        del _locks[filepath]
+    with _lock:
+        if filepath in _locks:
+            logging.info('Revoking lock on %s.', filepath)
+            lock = _locks.pop(filepath)
+            _idle.discard(filepath)
+            _log(['R', filepath])
+            _log_change('-%s=%d' % (filepath, lock.lock_id))
+
+
+def _log(record):
+    """Append record to the write-ahead log, and compact it if it's too
+       long, the lock must be held.
+    """
+
+    _wal.append(record)
+
+    if _wal.records > _wal.max_records:
+        _wal.compact(_grant_record(filepath, lock)
+                     for filepath, lock in _locks.items())
+
+
+def _replay():
+    """Rebuild the table of locks from the write-ahead log."""
+
+    for record in _wal.replay():
+        op, filepath = record[:2]
+
+        if op == 'G':
+            lock_id, granted, last_used = record[2:]
+            _locks[filepath] = Lock(lock_id, _datetime(granted),
+                                    _datetime(last_used))
+        elif op == 'U' and filepath in _locks:
+            _locks[filepath] = _locks[filepath]._replace(
+                    last_used=_datetime(record[2]))
+        elif op == 'R':
+            _locks.pop(filepath, None)
+
+    logging.info('%d locks loaded.', len(_locks))
+
+
+def _grant_record(filepath, lock):
+    """Return the record of the write-ahead log which grants lock."""
+
+    return ['G', filepath, lock.lock_id, _timestamp(lock.granted),
+            _timestamp(lock.last_used)]
+
+
+def _read_records(path):
+    """Yield the (record, offset of its end) of the JSON records in the
+       file path, until the first one which is incomplete.
+    """
+
+    if not os.path.exists(path):
+        return
+
+    end = 0
+
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+
+            end += len(line)
+            yield record, end
+
+
+def _timestamp(t):
+    """datetime → seconds since epoch."""
+
+    return time.mktime(t.timetuple()) + t.microsecond / 10.0 ** 6
+
+
+def _datetime(timestamp):
+    """seconds since epoch → datetime."""
+
+    return datetime.datetime.fromtimestamp(timestamp)
 
 
 _config = {
-            'dbfile': 'locks.db',
+            'walfile': 'locks.wal',
+            'snapshotfile': 'locks.snapshot',
+            'wal_max_records': 100000,
             'lock_lifetime': 60,
+            # maximum time a writer waits for the readers to release their
+            # shared leases
+            'drain_wait': 10,
+            # shared with the fileservers to sign the locks, see _token
+            'secret': None,
+            'changelog_size': 10000,
+            # maximum time a request can wait for the changes, or for a
+            # lock (such a request holds a thread of the server, the locks
+            # wait less than lock_lifetime / 2)
+            'max_wait': 60,
+            # maximum number of requests waiting for a lock at the same
+            # time, and for the changes (one per fileserver), together
+            # below the number of threads of the server (10 for the one
+            # of web.py) so the locks can still be released & renewed
+            'max_waiters': 4,
+            'max_followers': 4,
          }
 
 logging.info('Loading config file lockserver.dfs.json.')
 utils.load_config(_config, 'lockserver.dfs.json')
-_locks = shelve.open(_config['dbfile'])
 
-atexit.register(lambda: _locks.close())
+# filepath → Lock, and filepath → {lock_id → Lock} for the shared
+# leases (only in memory, see _grant_shared_lease), all the accesses are
+# made with _lock held
+_locks = {}
+_leases = {}
+# the filepaths whose lock is idle (only in memory, see _set_idle)
+_idle = set()
+# filepath → FIFO of the requests waiting for its lock (see
+# _grant_new_lock)
+_queues = {}
+# number of requests waiting for a lock, see _waiting, and for the
+# changes, see _following
+_waiters = 0
+_followers = 0
+_lock = threading.RLock()
+_wal = WriteAheadLog(_config['walfile'], _config['snapshotfile'],
+                     _config['wal_max_records'])
+_replay()
+
+# min-heap of (deadline, filepath, lock_id), see _push_deadline
+_deadlines = [(_deadline(lock), filepath, lock.lock_id)
+              for filepath, lock in _all_locks()]
+heapq.heapify(_deadlines)
+_sweeper = threading.Condition(_lock)
+
+# the last changes of the table, (seq, line), see _log_change, the
+# incarnation distinguishes the versions of this run from the former ones
+_changes = collections.deque(maxlen=_config['changelog_size'])
+_seq = 0
+_incarnation = '%x' % random.getrandbits(32)
+_feed = threading.Condition(_lock)
+
+_sweeper_thread = threading.Thread(target=_sweep_forever)
+_sweeper_thread.daemon = True
+_sweeper_thread.start()
+
+atexit.register(lambda: _wal.close())
 
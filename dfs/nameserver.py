@@ -3,7 +3,10 @@
 import atexit
 import logging
 import os
+import random
 import shelve
+import threading
+import time
 
 import web
 
@@ -12,11 +15,38 @@ import utils
 class NameServer:
     """NameServer is responsible of the mapping between directory names
        and file servers.
+
+       Each directory is served by a replica set: the list of the servers
+       which registered it, in the order they did (e.g.
+       fs1:8000,fs2:8000).
+
+       The fileservers send heartbeats with their load (see _heartbeat),
+       those which stop sending them are removed from the replica sets.
+
+       It also holds the chunk maps of the files stored in chunks over
+       the fileservers (see the chunks var of the methods): one line per
+       chunk, in order, 'chunk_id servers size md5', the chunk being
+       stored in /.chunks/chunk_id on each of the servers (e.g.
+       fs1:8000,fs2:8000, see chunk_replicas).
     """
 
     def GET(self, filepath):
-        """Return a server which hold the directory in which filepath is
-           located. If filepath is "/" return a list of directory/server.
+        """Return the replica set of the deepest directory containing
+           filepath (its mount point, e.g. a server registered for /src
+           serves /src/vim/main.c), the least loaded servers first (see
+           _by_load). If filepath is "/" return a list of directory/replica
+           set, or the load of the servers if the servers var is given
+           (server=active requests,bytes/s,free bytes,seconds since the
+           last heartbeat).
+
+           The mapping has a version (in the X-Names-Version header of the
+           response for "/") incremented on each change, if the since var
+           is given only the changes made after this version are returned,
+           one directory/server per line (directory= if it was removed),
+           or '410 Gone' if they are too old to be known.
+
+           If the chunks var is given, return the chunk map of filepath
+           instead, or '404 Not Found' if it isn't stored in chunks.
 
            filepath: an absolute path to a file (not a directory!)
         """
@@ -24,27 +54,277 @@ class NameServer:
         web.header('Content-Type', 'text/plain; charset=UTF-8')
         filepath = str(filepath)
 
+        if 'chunks' in web.input(_method='get'):
+            if filepath not in _chunks:
+                raise web.notfound()
+
+            return _chunks[filepath]
+
         if filepath == '/':
-            return '\n'.join('%s=%s' % (dirpath, _names[dirpath])
-                    for dirpath in sorted(_names))
+            i = web.input()
+
+            with _lock:
+                if 'servers' in i:
+                    return _get_servers()
+
+                web.header('X-Names-Version', str(_version()))
 
-        dirpath = str(os.path.dirname(filepath))
+                if 'since' in i:
+                    return _get_changes(web.intget(i['since'], -1))
 
-        if dirpath in _names:
-            return _names[dirpath]
+                return '\n'.join('%s=%s' % (dirpath, _names[dirpath])
+                        for dirpath in sorted(_names))
+
+        srv = _resolve(filepath)
+
+        if srv is not None:
+            return srv
 
         raise web.notfound('No file server serve this file.')
 
 
     def POST(self, dirpath):
-        """See _update (with add=True)."""
+        """If dirpath == '/' and the 'paths' var is present, resolve all
+           the filepaths it contains (separated by \\n) at once, and return
+           a list of filepath=server like this:
+               /data/sample.in=fs1:8000
+               /src/linux/kernel.h=fs2:8000
+           The filepaths that no server serve are not in the list.
+
+           If the chunks var is present, return chunks (its value) new
+           chunk ids and the servers where to store them, one 'chunk_id
+           servers' per line (see _allocate_chunks).
+
+           If the missed var is present, the fileserver it names missed a
+           write (another replica couldn't forward it, see
+           fileserver._replicate): the answer to its next heartbeat is
+           'RESYNC', so it resyncs its directories.
+
+           Otherwise see _update (with add=True), if it's a heartbeat
+           (the active var is present) the answer is 'RESYNC' if the
+           fileserver must resync its directories.
+        """
+
+        dirpath = str(dirpath)
+        i = web.input()
+
+        if 'chunks' in i:
+            web.header('Content-Type', 'text/plain; charset=UTF-8')
+            return _allocate_chunks(web.intget(i['chunks'], 0))
+
+        if dirpath == '/' and 'paths' in i:
+            web.header('Content-Type', 'text/plain; charset=UTF-8')
+            servers = ((filepath, _resolve(str(filepath)))
+                       for filepath in i['paths'].split('\n') if filepath)
+
+            return '\n'.join('%s=%s' % (filepath, srv)
+                             for filepath, srv in servers if srv is not None)
+
+        if 'missed' in i:
+            with _lock:
+                _resync.add(i['missed'])
+
+            return 'OK'
+
+        if 'active' in i and _heartbeat(i):
+            _update(dirpath)
+            return 'RESYNC'
+
+        return _update(dirpath)
+
+    def PUT(self, filepath):
+        """Replace the chunk map of filepath by the request data (the
+           chunks var must be given), and return the former one (if any).
+
+           Like for the directories, nothing checks the client holds the
+           lock of filepath.
+        """
+
+        web.header('Content-Type', 'text/plain; charset=UTF-8')
+        filepath = str(filepath)
+
+        if 'chunks' not in web.input(_method='get'):
+            raise web.nomethod()
 
-        return _update(str(dirpath))
+        with _lock:
+            former = _chunks.get(filepath, '')
+            _chunks[filepath] = web.data()
+
+        return former
 
     def DELETE(self, dirpath):
-        """See _update (with add=False)."""
+        """If the chunks var is given, remove the chunk map of dirpath (a
+           filepath then) and return it ('' if there was none).
+
+           Otherwise see _update (with add=False).
+        """
+
+        dirpath = str(dirpath)
+
+        if 'chunks' in web.input(_method='get'):
+            web.header('Content-Type', 'text/plain; charset=UTF-8')
+
+            with _lock:
+                return _chunks.pop(dirpath, '')
+
+        return _update(dirpath, False)
+
+
+def _version():
+    """Return the current version of the mapping."""
+
+    return _changes.get('version', 0)
+
+
+def _get_changes(since):
+    """Return the changes made after the version since (see
+       NameServer.GET), the lock must be held.
+    """
+
+    version = _version()
+
+    if since == version:
+        return ''
+
+    if since > version or str(since + 1) not in _changes:
+        raise web.gone()
+
+    changes = (_changes[str(v)] for v in xrange(since + 1, version + 1))
+    return '\n'.join('%s=%s' % (dirpath, srv or '')
+                     for dirpath, srv in changes)
+
+
+def _log_change(dirpath, srv):
+    """Record a new version of the mapping: dirpath is now served by srv
+       (None if it was removed). Only the last changelog_size changes are
+       kept.
+    """
+
+    version = _version() + 1
+    _changes[str(version)] = (dirpath, srv)
+    _changes['version'] = version
+
+    oldest = str(version - _config['changelog_size'])
+
+    if oldest in _changes:
+        del _changes[oldest]
+
 
-        return _update(str(dirpath), False)
+def _resolve(filepath):
+    """Return the replica set of the mount point of filepath, or None."""
+
+    srv = _mounts.resolve(filepath)[1]
+
+    return srv and _by_load(srv)
+
+
+def _allocate_chunks(count):
+    """Return count new chunk ids, and the servers where to store them,
+       one 'chunk_id servers' per line (e.g. fs1:8000,fs2:8000). Each
+       chunk is stored on chunk_replicas distinct servers (or all of
+       them if there are fewer), spread over the servers which send
+       heartbeats, the least loaded ones first.
+    """
+
+    with _lock:
+        servers = utils.get_replicas(_by_load(','.join(_servers)))
+
+    if not servers:
+        raise web.webapi.HTTPError('503 Service Unavailable',
+                                   {'Content-Type': 'text/plain'})
+
+    copies = max(1, min(_config['chunk_replicas'], len(servers)))
+
+    return '\n'.join('%032x %s' % (random.getrandbits(128),
+                                    ','.join(servers[(n + k) % len(servers)]
+                                             for k in xrange(copies)))
+                     for n in xrange(count))
+
+
+def _by_load(srv):
+    """Return the replica set srv with the least loaded servers first: the
+       ones with enough free space (min_free), then the ones with the
+       fewest active requests, then the fewest bytes/s. The servers
+       which are equally loaded (e.g. whose load is unknown) are in a
+       random order.
+    """
+
+    replicas = utils.get_replicas(srv)
+
+    if len(replicas) < 2:
+        return srv
+
+    def load(srv):
+        if srv not in _servers:
+            return (False, 0, 0)
+
+        _, active, rate, free = _servers[srv]
+        return (free < _config['min_free'], active, rate)
+
+    random.shuffle(replicas)
+    replicas.sort(key=load)
+
+    return ','.join(replicas)
+
+
+def _get_servers():
+    """Return the load of the servers (see NameServer.GET)."""
+
+    now = time.time()
+
+    return '\n'.join('%s=%d,%d,%d,%d' % (srv, active, rate, free, now - seen)
+                     for srv, (seen, active, rate, free)
+                     in sorted(_servers.items()))
+
+
+def _heartbeat(i):
+    """Record the heartbeat of the fileserver i.srv (see
+       fileserver._heartbeat): the time it was received, and the active,
+       rate & free vars (its load).
+
+       Return True if the fileserver must resync its directories: it was
+       considered dead (see _reap_forever), or it missed a write (see
+       NameServer.POST).
+    """
+
+    with _lock:
+        if i['srv'] not in _servers:
+            logging.info('%s sends heartbeats.', i['srv'])
+
+        _servers[i['srv']] = (time.time(), web.intget(i['active'], 0),
+                              web.intget(i.get('rate'), 0),
+                              web.intget(i.get('free'), 0))
+
+        if i['srv'] in _resync:
+            _resync.remove(i['srv'])
+            return True
+
+        return False
+
+
+def _reap_forever():
+    """Remove the fileservers which didn't send a heartbeat for more than
+       server_timeout seconds from the replica sets (the servers which
+       never sent one are kept).
+    """
+
+    while True:
+        time.sleep(_config['server_timeout'] / 2.)
+
+        with _lock:
+            now = time.time()
+            dead = [srv for srv, (seen, _, _, _) in _servers.items()
+                    if now - seen > _config['server_timeout']]
+
+            for srv in dead:
+                logging.warning('%s is dead.', srv)
+                del _servers[srv]
+                # it misses the writes from now on
+                _resync.add(srv)
+
+                for dirpath in _names.keys():
+                    if srv in utils.get_replicas(_names[dirpath]):
+                        _update_names(dirpath, srv, False)
 
 
 def _update(dirpath, add=True):
@@ -58,9 +338,13 @@ def _update(dirpath, add=True):
 
             Else associate the 'dirpath' directory to the 'srv' query var.
 
+            If the directory is already served, srv is added at the end
+            of its replica set.
+
         Else:
             Act in the same fashion as if add is True except that it
-            removes pair directory/servers instead of adding them.
+            removes srv from the replica sets of the directories (and the
+            directories which aren't served anymore).
 
         Obviously there's a security hole here because everybody can
         fake/delete servers, so to be used in real world it would need
@@ -106,37 +390,85 @@ def _update_names(dirpath, srv, add=True):
     """Just update the name dictionnary and the database.
 
        dirpath: the path to the directory to update
-       srv: the server to associate to dirpath (not used if add=False)
-       add: if True add the couple (dirpath, srv) else delete the dirpath
-            from the dictionnary and the database
-
-       Notes: srv is unused when add=False but it still required because
-              it'll be useful if we want to implement replication.
+       srv: the server to add to/remove from the replica set of dirpath
+       add: if True add srv to the replica set of dirpath else remove it
+            (and dirpath if it was its last server) from the dictionnary
+            and the database
     """
 
     if dirpath[-1] == '/':
         dirpath = os.path.dirname(dirpath)
 
-    if add:
-        logging.info('Update directory %s on %s.', dirpath, srv)
-        _names[dirpath] = srv
+    with _lock:
+        replicas = utils.get_replicas(_names.get(dirpath))
 
-    elif dirpath in _names:
-        logging.info('Remove directory %s on %s.', dirpath, srv)
-        del _names[dirpath]
+        if add:
+            if srv in replicas:
+                # nothing changed (e.g. a fileserver restarted)
+                return
 
-    else:
-        raise ValueError('%s wasn\'t not deleted, because it wasn\'t'
-                         ' in the dictionnary/database.' % dirpath)
+            logging.info('Update directory %s on %s.', dirpath, srv)
+            replicas.append(srv)
+
+        elif srv in replicas:
+            logging.info('Remove directory %s on %s.', dirpath, srv)
+            replicas.remove(srv)
+
+        else:
+            raise ValueError('%s wasn\'t not deleted, because it wasn\'t'
+                             ' in the dictionnary/database.' % dirpath)
+
+        if replicas:
+            _names[dirpath] = ','.join(replicas)
+            _mounts.add(dirpath, _names[dirpath])
+            _log_change(dirpath, _names[dirpath])
+        else:
+            del _names[dirpath]
+            _mounts.remove(dirpath)
+            _log_change(dirpath, None)
 
 
 _config = {
             'dbfile': 'names.db',
+            'changesfile': 'changes.db',
+            'chunksfile': 'chunks.db',
+            'changelog_size': 10000,
+            # seconds without heartbeat after which a server is dead
+            'server_timeout': 20,
+            # the servers with less free bytes are the last choice
+            'min_free': 64 * 1024 ** 2,
+            # number of servers storing each chunk
+            'chunk_replicas': 2,
          }
 
 logging.info('Loading config file nameserver.dfs.json.')
 utils.load_config(_config, 'nameserver.dfs.json')
 _names = shelve.open(_config['dbfile'])
+# version → (dirpath, srv) + 'version' → the current version
+_changes = shelve.open(_config['changesfile'])
+# filepath → its chunk map (see NameServer)
+_chunks = shelve.open(_config['chunksfile'])
+_lock = threading.RLock()
+
+# the same mapping as _names, to resolve the filepaths without going
+# through all the directories
+_mounts = utils.PathTrie()
+
+for dirpath in _names:
+    _mounts.add(dirpath, _names[dirpath])
+
+# server → (time of its last heartbeat, active requests, bytes/s, free
+# bytes), see _heartbeat
+_servers = {}
+
+# the servers which must resync their directories, see _heartbeat
+_resync = set()
+
+_reaper = threading.Thread(target=_reap_forever)
+_reaper.daemon = True
+_reaper.start()
 
 atexit.register(lambda: _names.close())
+atexit.register(lambda: _changes.close())
+atexit.register(lambda: _chunks.close())
 
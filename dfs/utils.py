@@ -1,43 +1,490 @@
 #-*- coding: utf-8 -*-
 
+import collections
+import hashlib
+import hmac
+import httplib
 import json
 import os.path
+import select
+import socket
+import threading
+import time
+import urllib
 
-from contextlib import closing
+from contextlib import contextmanager
 from httplib import HTTPConnection
 
-class memoize:
-    """Decorator, equivalent of the Python 3 functools.lru_cache(None)."""
+class LockRefused(Exception):
+    """The lock server refused to grant a lock (the file is locked), see
+       get_lock.
+    """
+
+    pass
+
 
-    def __init__(self, fn):
+class ttl_memoize:
+    """Decorator, memoize the results of a function for ttl seconds
+       (negative_ttl seconds for None, which means a failed lookup), and
+       keep at most max_size results (the least recently used are dropped).
+
+       The attributes ttl, negative_ttl & max_size can be changed after
+       the decoration (e.g. from a config file).
+    """
+
+    def __init__(self, fn, ttl=60, negative_ttl=5, max_size=10000):
         """fn: the function to decorate."""
 
         self.fn = fn
-        self.cache = {}
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        # key → (expiration, result), in LRU order
+        self.cache = collections.OrderedDict()
+        self._lock = threading.Lock()
 
     def __call__(self, *args, **kwds):
-        """Check if we already have the answer and return it, otherwise
+        """Check if we already have a fresh answer and return it, otherwise
            compute it and store the result."""
 
-        key = tuple(args) + tuple(kwds)
+        key = _key(args, kwds)
+
+        with self._lock:
+            if key in self.cache:
+                expiration, ans = self.cache.pop(key)
 
-        if key in self.cache:
-            return self.cache[key]
+                if expiration > time.time():
+                    self.cache[key] = (expiration, ans)
+                    return ans
 
         ans = self.fn(*args, **kwds)
-        return self.cache.setdefault(key, ans)
+        self.set(ans, *args, **kwds)
+
+        return ans
+
+    def set(self, ans, *args, **kwds):
+        """Store ans as the result of the function for *args & **kwds
+           (e.g. if it was obtained by a bulk request).
+        """
+
+        ttl = self.negative_ttl if ans is None else self.ttl
+        key = _key(args, kwds)
+
+        with self._lock:
+            self.cache.pop(key, None)
+            self.cache[key] = (time.time() + ttl, ans)
+
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def invalidate(self, *args, **kwds):
+        """Forget the result of the function for *args & **kwds."""
+
+        with self._lock:
+            self.cache.pop(_key(args, kwds), None)
 
     def renew(self, *args, **kwds):
         """Delete the previous return value of the function for arguments
            *args & **kwds and recompute the result.
         """
 
-        key = tuple(args) + tuple(kwds)
+        self.invalidate(*args, **kwds)
+        return self(*args, **kwds)
+
 
-        if key in self.cache:
-            del self.cache[key]
+def _key(args, kwds):
+    """Return a hashable key from the arguments of a function call."""
 
-        return self(*args, **kwds)
+    return tuple(args) + tuple(sorted(kwds.items()))
+
+
+class NameMap:
+    """Local copy of the directory → server mapping of a nameserver, kept
+       up to date by asking only the changes since its version.
+    """
+
+    def __init__(self):
+        self.names = {}
+        # the same mapping, to find the mount point of a filepath
+        self.mounts = PathTrie()
+        self.version = None
+        # time of the last sync
+        self.synced = 0
+        self._lock = threading.Lock()
+
+    def sync(self, host, port):
+        """Get the changes since the last sync from the nameserver
+           host:port, or the whole mapping the first time (or if the
+           changes are too old to be known by the nameserver).
+        """
+
+        with self._lock:
+            if self.version is not None:
+                status, version, body = _get_names(host, port,
+                                                   '/?since=%d' % self.version)
+
+                if status == 410:
+                    self.version = None
+
+            if self.version is None:
+                status, version, body = _get_names(host, port, '/')
+                self.names.clear()
+                self.mounts = PathTrie()
+
+            if status != 200:
+                raise Exception('Unable to sync the names (%d).' % status)
+
+            for line in body.split('\n'):
+                if not line:
+                    continue
+
+                dirpath, srv = line.split('=', 1)
+
+                if srv:
+                    self.names[dirpath] = srv
+                    self.mounts.add(dirpath, srv)
+                elif self.names.pop(dirpath, None) is not None:
+                    self.mounts.remove(dirpath)
+
+            self.version = version
+            self.synced = time.time()
+
+    def get_server(self, filepath):
+        """Return the replica set owning filepath (or None), see
+           get_replicas.
+        """
+
+        return self.mounts.resolve(filepath)[1]
+
+
+class PathTrie:
+    """Mapping of directories (mount points) to values, which finds the
+       deepest directory containing a filepath in O(depth of filepath),
+       whatever the number of directories.
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+
+    def add(self, dirpath, value):
+        """Associate value to dirpath (and all the paths below it)."""
+
+        node = self._root
+
+        for name in _path_components(dirpath):
+            node = node.children.setdefault(name, _TrieNode())
+
+        node.dirpath, node.value = dirpath, value
+
+    def remove(self, dirpath):
+        """Remove dirpath, raise a KeyError if it isn't there."""
+
+        nodes = [(None, self._root)]
+
+        for name in _path_components(dirpath):
+            node = nodes[-1][1].children.get(name)
+
+            if node is None:
+                raise KeyError(dirpath)
+
+            nodes.append((name, node))
+
+        node = nodes[-1][1]
+
+        if node.dirpath is None:
+            raise KeyError(dirpath)
+
+        node.dirpath = node.value = None
+
+        # drop the nodes which lead nowhere now
+        for (name, node), (_, parent) in zip(reversed(nodes[1:]),
+                                             reversed(nodes[:-1])):
+            if node.dirpath is not None or node.children:
+                break
+
+            del parent.children[name]
+
+    def resolve(self, filepath):
+        """Return (dirpath, value) for the deepest dirpath containing
+           filepath, or (None, None).
+        """
+
+        node = found = self._root
+
+        for name in _path_components(os.path.dirname(filepath)):
+            node = node.children.get(name)
+
+            if node is None:
+                break
+
+            if node.dirpath is not None:
+                found = node
+
+        return found.dirpath, found.value
+
+
+class _TrieNode(object):
+    """A directory of a PathTrie, dirpath is None if it isn't a mount
+       point.
+
+       It's a new-style class, so __slots__ keeps the nodes small.
+    """
+
+    __slots__ = ('dirpath', 'value', 'children')
+
+    def __init__(self):
+        self.dirpath = self.value = None
+        self.children = {}
+
+
+def _path_components(path):
+    """Return the list of the names in path, e.g. /src/vim/ → [src, vim]."""
+
+    return [name for name in path.split('/') if name]
+
+
+def _get_names(host, port, url):
+    """GET url on the nameserver, return the status, the version of the
+       mapping and the body of the response.
+    """
+
+    with pool.connection(host, port) as con:
+        response = request(con, 'GET', url)
+        body = response.read()
+
+    version = response.getheader('X-Names-Version')
+
+    return response.status, version and int(version), body
+
+
+class LockMap:
+    """Local copy of the filepath → lock_id table of a lockserver (the
+       shared leases aren't in it), kept up to date by long polling its
+       changes.
+
+       synced is False until the first sync, and after a failed one, the
+       copy can't be trusted then.
+    """
+
+    def __init__(self):
+        self.locks = {}
+        self.version = None
+        self.synced = False
+        self._lock = threading.Lock()
+
+    def sync(self, host, port, wait=0):
+        """Get the changes since the last sync from the lockserver
+           host:port, waiting at most wait seconds for them, or the whole
+           table the first time (or if the changes are too old to be known
+           by the lockserver).
+        """
+
+        with self._lock:
+            try:
+                self._sync(host, port, wait)
+            except:
+                self.synced = False
+                raise
+
+    def _sync(self, host, port, wait):
+        """See sync, the lock must be held."""
+
+        if self.version is not None:
+            status, version, body = _get_locks(host, port,
+                    '/?since=%s&wait=%d' % (self.version, wait))
+
+            if status == 410:
+                self.version = None
+
+        if self.version is None:
+            status, version, body = _get_locks(host, port, '/?lock_ids')
+            self.locks.clear()
+
+        if status != 200:
+            raise Exception('Unable to sync the locks (%d).' % status)
+
+        for line in body.split('\n'):
+            if not line:
+                continue
+
+            # +filepath=lock_id, or -filepath=lock_id (revoked)
+            filepath, lock_id = line[1:].rsplit('=', 1)
+            lock_id = int(lock_id)
+
+            if line[0] == '+':
+                self.locks[filepath] = lock_id
+            elif self.locks.get(filepath) == lock_id:
+                del self.locks[filepath]
+
+        self.version = version
+        self.synced = True
+
+
+def _get_locks(host, port, url):
+    """GET url on the lockserver, return the status, the version of the
+       table and the body of the response.
+    """
+
+    with pool.connection(host, port) as con:
+        response = request(con, 'GET', url)
+        body = response.read()
+
+    return response.status, response.getheader('X-Locks-Version'), body
+
+
+class ConnectionPool:
+    """Keep-alive HTTP connections, pooled per host:port.
+
+       At most max_size idle connections are kept for each host, and a
+       connection which wasn't used for more than idle_timeout seconds is
+       closed instead of being reused (the server probably dropped it).
+    """
+
+    def __init__(self, max_size=4, idle_timeout=30):
+        """max_size: the maximum number of idle connections per host
+           idle_timeout: number of seconds after which an idle connection
+                         is evicted
+        """
+
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def acquire(self, host, port):
+        """Return a connection to host:port, reuse an idle one if possible."""
+
+        now = time.time()
+
+        with self._lock:
+            idle = self._idle[(host, port)]
+
+            # the oldest connections are on the left
+            while idle and now - idle[0][1] > self.idle_timeout:
+                idle.popleft()[0].close()
+
+            if idle:
+                return idle.pop()[0]
+
+        return HTTPConnection(host, port)
+
+    def release(self, con):
+        """Give back con to the pool, the last response must have been
+           read entirely, otherwise the connection is just closed.
+        """
+
+        response = getattr(con, 'dfs_response', None)
+        con.dfs_response = None
+
+        if con.sock is None or (response is not None and
+                                not response.isclosed()):
+            con.close()
+            return
+
+        with self._lock:
+            idle = self._idle[(con.host, con.port)]
+
+            if len(idle) >= self.max_size:
+                con.close()
+            else:
+                idle.append((con, time.time()))
+
+    def clear(self):
+        """Close all the idle connections."""
+
+        with self._lock:
+            for idle in self._idle.values():
+                while idle:
+                    idle.pop()[0].close()
+
+    @contextmanager
+    def connection(self, host, port):
+        """Context manager which acquires a connection and releases it
+           afterward (or closes it if an exception was raised).
+        """
+
+        con = self.acquire(host, port)
+
+        try:
+            yield con
+        except:
+            con.close()
+            raise
+
+        self.release(con)
+
+
+def request(con, method, url, body=None, headers={}):
+    """Send a request using con and return the response.
+
+       If con is a kept-alive connection that the server closed in the
+       meantime, reconnect and send the request once again. Only the
+       idempotent requests (GET, HEAD, PUT, DELETE) are sent again, the
+       other ones (e.g. an append) may have been handled: they're sent on
+       a new connection if the server already closed this one.
+    """
+
+    idempotent = method in ('GET', 'HEAD', 'PUT', 'DELETE')
+
+    if con.sock is not None and not idempotent and _dropped(con.sock):
+        con.close()
+
+    reused = con.sock is not None and idempotent
+    # a file-like body has to be rewinded before being sent again
+    start = body.tell() if hasattr(body, 'read') else None
+
+    try:
+        con.request(method, url, body, headers)
+        response = con.getresponse()
+    except (socket.error, httplib.HTTPException):
+        if not reused:
+            raise
+
+        con.close()
+
+        if start is not None:
+            body.seek(start)
+
+        con.request(method, url, body, headers)
+        response = con.getresponse()
+
+    con.dfs_response = response
+    return response
+
+
+def _dropped(sock):
+    """Return True if the server closed the idle connection sock (i.e.
+       it's readable, there's nothing else to read on it).
+    """
+
+    try:
+        return bool(select.select([sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+def block_checksums(f, block_size):
+    """Return a tuple (digest, sums) where digest is the md5 of the whole
+       content of the file-like object f and sums the list of the md5 of
+       each block of block_size bytes (the last one may be shorter).
+
+       f is read from its begining, and its position is restored after.
+    """
+
+    position = f.tell()
+    f.seek(0)
+
+    whole, sums = hashlib.md5(), []
+    block = f.read(block_size)
+
+    while block:
+        whole.update(block)
+        sums.append(hashlib.md5(block).hexdigest())
+        block = f.read(block_size)
+
+    f.seek(position)
+
+    return whole.hexdigest(), sums
 
 
 def load_config(config, filepath):
@@ -62,32 +509,133 @@ def get_host_port(s):
     return host, int(port)
 
 
-def is_locked(filepath, host, port, lock_id=None):
+def get_lockserver(filepath, lockservers):
+    """Return the address (host, port) of the lock server of filepath.
+
+       lockservers: 'host:port', or a list of them (the shards, each one
+                    owns a range of the hashes of the paths).
+    """
+
+    lockservers = get_lockservers(lockservers)
+
+    return lockservers[_shard(filepath, len(lockservers))]
+
+
+def get_lockservers(lockservers):
+    """Return the addresses (host, port) of all the lock servers (see
+       get_lockserver).
+    """
+
+    if isinstance(lockservers, basestring):
+        lockservers = [lockservers]
+
+    return [get_host_port(lockserver) for lockserver in lockservers]
+
+
+def split_by_lockserver(items, lockservers):
+    """Split items (filepaths, or tuples starting by a filepath) by lock
+       server (see get_lockserver), return a list of ((host, port), items).
+
+       The lock servers are in the order of the shards and the items are
+       sorted, so all the clients ask the locks of a batch in the same
+       order (which can't create dead locks).
+    """
+
+    lockservers = get_lockservers(lockservers)
+    shards = collections.defaultdict(list)
+
+    for item in items:
+        filepath = item if isinstance(item, basestring) else item[0]
+        shards[_shard(filepath, len(lockservers))].append(item)
+
+    return [(lockservers[n], sorted(shards[n])) for n in sorted(shards)]
+
+
+def _shard(filepath, n):
+    """Return the shard (among n) owning filepath."""
+
+    if isinstance(filepath, unicode):
+        filepath = filepath.encode('utf-8')
+
+    h = int(hashlib.md5(filepath).hexdigest()[:8], 16)
+
+    return (h * n) >> 32
+
+
+def is_locked(filepath, host, port, lock_id=None, write=False):
     """Ask the lock server host:port if filepath is locked, if lock_id is
        supplied, ask the lock server using this id.
+
+       write: if True, the shared leases lock the file too (and lock_id
+              can't be one).
     """
 
-    with closing(HTTPConnection(host, port)) as con:
-        if lock_id is not None:
-            filepath += '?lock_id=%s' % lock_id
+    query = []
+
+    if lock_id is not None:
+        query.append('lock_id=%s' % lock_id)
+
+    if write:
+        query.append('write=1')
 
-        con.request('GET', filepath)
+    if query:
+        filepath += '?' + '&'.join(query)
 
-        r = con.getresponse()
+    with pool.connection(host, port) as con:
+        r = request(con, 'GET', filepath)
+        r.read()
 
     return r.status != 200
 
 
-@memoize
+def lock_token(secret, filepath, lock_id, expiration):
+    """Return the token of the lock lock_id on filepath, valid until
+       expiration (seconds since epoch): 'lock_id:expiration:signature'.
+    """
+
+    if isinstance(filepath, unicode):
+        filepath = filepath.encode('utf-8')
+
+    msg = '%s\n%d\n%d' % (filepath, lock_id, expiration)
+    signature = hmac.new(str(secret), msg, hashlib.sha256).hexdigest()
+
+    return '%d:%d:%s' % (lock_id, expiration, signature)
+
+
+def check_lock_token(secret, filepath, token, expired_ok=False):
+    """Return the lock_id of token if it's a valid (and not expired, unless
+       expired_ok) lock token for filepath, otherwise None.
+    """
+
+    try:
+        lock_id, expiration, _ = str(token).split(':')
+        lock_id, expiration = int(lock_id), int(expiration)
+    except ValueError:
+        return None
+
+    if expiration < time.time() and not expired_ok:
+        return None
+
+    if not hmac.compare_digest(lock_token(secret, filepath, lock_id,
+                                          expiration), str(token)):
+        return None
+
+    return lock_id
+
+
+@ttl_memoize
 def get_server(filepath, host, port):
-    """Return a server owning filepath.
+    """Return the replica set owning filepath (or None), see
+       get_replicas.
 
        host & port: the address & port of a name server.
+
+       The result is cached, see ttl_memoize (get_server.invalidate can
+       be used when a fileserver doesn't serve filepath anymore).
     """
 
-    with closing(HTTPConnection(host, port)) as con:
-        con.request('GET', filepath)
-        response = con.getresponse()
+    with pool.connection(host, port) as con:
+        response = request(con, 'GET', filepath)
         status, srv = response.status, response.read()
 
     if status == 200:
@@ -96,27 +644,266 @@ def get_server(filepath, host, port):
     return None
 
 
-def get_lock(filepath, host, port):
-    """Try to get a lock from the lockserver (host, port), if not able
-       to get it, raise an Exception.
+def get_replicas(srv):
+    """Return the list of the fileservers of a replica set, as given by
+       the nameserver (e.g. fs1:8000,fs2:8000, or None), the head of the
+       replication chain first.
+    """
+
+    return srv.split(',') if srv else []
+
+
+def get_servers(filepaths, host, port):
+    """Resolve all the filepaths in one request, return a dictionnary
+       filepath → server (or None), and fill the cache of get_server.
+
+       host & port: the address & port of a name server.
+    """
+
+    filepaths = list(filepaths)
+    data = urllib.urlencode({'paths': '\n'.join(filepaths)})
+
+    with pool.connection(host, port) as con:
+        response = request(con, 'POST', '/', data,
+                {'Content-Type': 'application/x-www-form-urlencoded'})
+        status, body = response.status, response.read()
+
+    if status != 200:
+        raise Exception('Unable to resolve the filepaths (%d).' % status)
+
+    servers = dict.fromkeys(filepaths)
+    servers.update(line.split('=', 1) for line in body.split('\n') if line)
+
+    for filepath in filepaths:
+        get_server.set(servers[filepath], filepath, host, port)
+
+    return servers
+
+
+def get_chunks(filepath, host, port):
+    """Return the chunk map of filepath, a list of (chunk_id, servers,
+       size, md5), servers being the replica set (see get_replicas)
+       storing the chunk, or None if it isn't stored in chunks (see
+       NameServer).
+
+       host & port: the address & port of a name server.
+    """
+
+    with pool.connection(host, port) as con:
+        response = request(con, 'GET', filepath + '?chunks')
+        status, body = response.status, response.read()
+
+    if status == 404:
+        return None
+
+    if status != 200:
+        raise Exception('Unable to get the chunks of %s (%d).'
+                        % (filepath, status))
+
+    return _decode_chunks(body)
+
+
+def allocate_chunks(filepath, count, host, port):
+    """Return a list of count (chunk_id, servers) where new chunks of
+       filepath can be stored, each one on all the servers of the replica
+       set servers.
+
+       host & port: the address & port of a name server.
+    """
+
+    with pool.connection(host, port) as con:
+        response = request(con, 'POST', '%s?chunks=%d' % (filepath, count),
+                           '')
+        status, body = response.status, response.read()
+
+    if status != 200:
+        raise Exception('Unable to allocate chunks for %s (%d).'
+                        % (filepath, status))
+
+    return [tuple(line.split(' ')) for line in body.split('\n') if line]
+
+
+def set_chunks(filepath, chunks, host, port):
+    """Replace the chunk map of filepath by chunks (see get_chunks), or
+       remove it if chunks is None, return the former one ([] if there
+       was none).
+
+       host & port: the address & port of a name server.
+    """
+
+    with pool.connection(host, port) as con:
+        if chunks is None:
+            response = request(con, 'DELETE', filepath + '?chunks')
+        else:
+            response = request(con, 'PUT', filepath + '?chunks',
+                               _encode_chunks(chunks))
+
+        status, body = response.status, response.read()
+
+    if status != 200:
+        raise Exception('Unable to update the chunks of %s (%d).'
+                        % (filepath, status))
+
+    return _decode_chunks(body)
+
+
+def _encode_chunks(chunks):
+    """Return the text of the chunk map chunks (see get_chunks)."""
+
+    return '\n'.join('%s %s %d %s' % chunk for chunk in chunks)
+
+
+def _decode_chunks(body):
+    """Return the chunk map in the text body (see get_chunks)."""
+
+    chunks = []
+
+    for line in body.split('\n'):
+        if line:
+            chunk_id, srv, size, md5 = line.split(' ')
+            chunks.append((chunk_id, srv, int(size), md5))
+
+    return chunks
+
+
+def get_lock(filepath, host, port, shared=False, wait=0):
+    """Try to get a lock from the lockserver (host, port), raise a
+       LockRefused if the file is locked (or an Exception if the lock
+       server can't be asked).
 
        filepath: the file on which we want the lock
        host & port: the address & port of a lock server.
+       shared: if True, get a shared lease (the file can be read by
+               others, but not written until it's released).
+       wait: seconds the lock server may wait for the file to be unlocked
+             (it can't be more than its max_wait), if it's too busy to
+             wait (503) we ask it again every second meanwhile.
+
+       Return the lock_id, or a lock token (see lock_token) if the lock
+       server has a secret.
     """
 
-    with closing(HTTPConnection(host, port)) as con:
-        con.request('POST', filepath)
-        response = con.getresponse()
-        status = response.status
+    deadline = time.time() + wait
 
-        if status != 200:
-            raise Exception('Unable to grant lock on %s.' % filepath)
+    while True:
+        with pool.connection(host, port) as con:
+            query = '?wait=%d' % max(deadline - time.time(), 0)
 
-        lock_id = response.read()
+            if shared:
+                query += '&shared=1'
+
+            response = request(con, 'POST', filepath + query)
+            status, lock_id = response.status, response.read()
+
+        if status != 503 or time.time() + 1 >= deadline:
+            break
+
+        time.sleep(1)
+
+    if status == 401:
+        raise LockRefused('Unable to grant lock on %s.' % filepath)
+
+    if status != 200:
+        raise Exception('Unable to grant lock on %s (%d).'
+                        % (filepath, status))
 
     return lock_id
 
 
+def get_locks(filepaths, lockservers):
+    """Get the locks of all the filepaths, with one request per lock server
+       (see get_lockserver), return a dictionnary filepath → lock_id.
+
+       If one of them can't be granted, the locks already granted are
+       revoked and an Exception is raised.
+    """
+
+    granted = {}
+
+    for (host, port), filepaths in split_by_lockserver(filepaths,
+                                                       lockservers):
+        with pool.connection(host, port) as con:
+            response = request(con, 'POST', '/', '\n'.join(filepaths))
+            status, body = response.status, response.read()
+
+        if status != 200:
+            if granted:
+                revoke_locks(granted.items(), lockservers)
+
+            raise Exception('Unable to grant the locks (%d).' % status)
+
+        granted.update(line.rsplit('=', 1)
+                       for line in body.split('\n') if line)
+
+    return granted
+
+
+def renew_locks(locks, lockservers):
+    """Renew the locks (a list of (filepath, lock_id)), with one request
+       per lock server (see get_lockserver), return the set of the
+       filepaths whose lock is lost.
+    """
+
+    lost = set()
+
+    for (host, port), locks in split_by_lockserver(locks, lockservers):
+        with pool.connection(host, port) as con:
+            response = request(con, 'PUT', '/', _encode_locks(locks),
+                    {'Content-Type': 'application/x-www-form-urlencoded'})
+            status, body = response.status, response.read()
+
+        if status != 200:
+            raise Exception('Unable to renew the locks (%d).' % status)
+
+        lost.update(line for line in body.split('\n') if line)
+
+    return lost
+
+
+def revoke_locks(locks, lockservers):
+    """Revoke the locks (a list of (filepath, lock_id)), with one request
+       per lock server (see get_lockserver).
+    """
+
+    for (host, port), locks in split_by_lockserver(locks, lockservers):
+        with pool.connection(host, port) as con:
+            # the vars of a DELETE are in the query string
+            response = request(con, 'DELETE', '/?' + _encode_locks(locks))
+            response.read()
+
+        if response.status != 200:
+            raise Exception('Unable to revoke the locks (%d).'
+                            % response.status)
+
+
+def _encode_locks(locks):
+    """Return the vars filepaths & lock_ids of the batch requests of the
+       lock servers, urlencoded.
+    """
+
+    return urllib.urlencode({
+        'filepaths': '\n'.join(filepath for filepath, _ in locks),
+        'lock_ids': '\n'.join(str(lock_id) for _, lock_id in locks),
+        })
+
+
+def idle_lock(filepath, host, port, lock_id, idle=True):
+    """Tell the lockserver host:port that the lock on filepath is kept
+       without being used, it's revoked if another client asks for
+       filepath. With idle=False, the lock is used again.
+
+       Return False if the lock was revoked (or expired).
+    """
+
+    query = '?lock_id=%s%s' % (lock_id, '&idle=1' if idle else '')
+
+    with pool.connection(host, port) as con:
+        response = request(con, 'PUT', filepath + query)
+        response.read()
+
+    return response.status == 200
+
+
 def revoke_lock(filepath, host, port, lock_id):
     """Revoke the lock on filepath, if it fails to revoke the lock,
        raise an Exception.
@@ -124,10 +911,14 @@ def revoke_lock(filepath, host, port, lock_id):
        host & port: the address & port of a lock server
        lock_id: the id of the current lock."""
 
-    with closing(HTTPConnection(host, port)) as con:
-        con.request('DELETE', filepath + ('?lock_id=%d' % int(lock_id)))
-        response = con.getresponse()
+    with pool.connection(host, port) as con:
+        response = request(con, 'DELETE', filepath + ('?lock_id=%s' % lock_id))
+        response.read()
 
     if response.status != 200:
         raise Exception('Unable to revoke lock on %s.' % filepath)
 
+
+
+# shared by all the clients/servers of the current process
+pool = ConnectionPool()
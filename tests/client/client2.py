@@ -13,7 +13,7 @@ if __name__ == '__main__':
     f.write('tro lol\n')
     f.close()
 
-    g = dfs.client.File.from_cache(fp)
+    g = dfs.client.File.from_cache(fp, 'ac')
     g.seek(0, 2)
     g.write('abc\n')
     g.close()
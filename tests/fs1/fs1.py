@@ -12,5 +12,5 @@ urls = (
 app = web.application(urls, globals())
 
 if __name__ == '__main__':
-    app.run()
+    app.run(dfs.fileserver.sendfile)
 
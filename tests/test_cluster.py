@@ -0,0 +1,427 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+"""Tests of a whole cluster: a nameserver, a lockserver and two replicas
+   of /data (fs1 & fs3) run as subprocesses in a temporary directory, the
+   client runs in this process.
+
+   Run from the root of the repository:
+       python2 -m unittest discover -s tests
+"""
+
+import atexit
+import httplib
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name → (module, class, config file, config)
+SERVERS = {
+    'names': ('nameserver', 'NameServer', 'nameserver.dfs.json',
+              {'server_timeout': 3}),
+    'locks': ('lockserver', 'LockServer', 'lockserver.dfs.json',
+              {'lock_lifetime': 15}),
+    'fs1': ('fileserver', 'FileServer', 'fileserver.dfs.json',
+            {'directories': ['/data'], 'fsroot': 'fs1/',
+             'heartbeat_interval': 1}),
+    'fs3': ('fileserver', 'FileServer', 'fileserver.dfs.json',
+            {'directories': ['/data'], 'fsroot': 'fs3/',
+             'heartbeat_interval': 1}),
+}
+
+# the servers are started in this order (the replicas register with the
+# nameserver in this order too, fs1 is the primary one)
+ORDER = ('names', 'locks', 'fs1', 'fs3')
+
+SCRIPT = '''import web
+import dfs.%(module)s
+app = web.application(('(/.*)', 'dfs.%(module)s.%(cls)s'), globals())
+app.run(%(middleware)s)
+'''
+
+_tmp = None
+_ports = {}
+_procs = {}
+c = None
+utils = None
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    return port
+
+
+def _addr(name):
+    return 'localhost:%d' % _ports[name]
+
+
+def _start(name):
+    """Start the server name (in its directory, so it finds its config and
+       its databases again after a restart), wait until it answers.
+    """
+
+    module, cls, _, _ = SERVERS[name]
+    script = SCRIPT % {'module': module, 'cls': cls,
+                       'middleware': 'dfs.fileserver.sendfile'
+                                     if module == 'fileserver' else ''}
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+                            ROOT, os.environ.get('PYTHONPATH')]))
+    cwd = os.path.join(_tmp, name)
+    log = open(os.path.join(_tmp, name + '.log'), 'a')
+    _procs[name] = subprocess.Popen([sys.executable, '-c', script,
+                                     str(_ports[name])],
+                                    cwd=cwd, env=env, stdout=log,
+                                    stderr=subprocess.STDOUT)
+    log.close()
+    deadline = time.time() + 10
+
+    while True:
+        try:
+            socket.create_connection(('localhost', _ports[name]), 1).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+
+            time.sleep(0.1)
+
+
+def _kill(name, sig=signal.SIGTERM):
+    proc = _procs.pop(name, None)
+
+    if proc is not None:
+        os.kill(proc.pid, sig)
+        proc.wait()
+
+
+def _http(name, method, url, body=None, headers={}):
+    con = httplib.HTTPConnection('localhost', _ports[name], timeout=10)
+
+    try:
+        con.request(method, url, body, headers)
+        response = con.getresponse()
+
+        return response.status, response.read()
+    finally:
+        con.close()
+
+
+def _wait_clean(name, timeout=20):
+    """Wait until the fileserver name has resynced /data."""
+
+    deadline = time.time() + timeout
+
+    while _http(name, 'GET', '/data?list=1')[0] != 200:
+        if time.time() > deadline:
+            raise AssertionError('%s is still resyncing /data.' % name)
+
+        time.sleep(0.2)
+
+
+def _local(name, filepath):
+    """Return the content of filepath on the disk of the fileserver name,
+       or None if it doesn't have it.
+    """
+
+    p = os.path.join(_tmp, name, SERVERS[name][3]['fsroot'],
+                     filepath.lstrip('/'))
+
+    if not os.path.exists(p):
+        return None
+
+    with open(p, 'rb') as f:
+        return f.read()
+
+
+def setUpModule():
+    global _tmp, c, utils
+
+    _tmp = tempfile.mkdtemp(prefix='dfs-tests-')
+
+    for name in SERVERS:
+        _ports[name] = _free_port()
+
+    for name, (_, _, config_file, config) in SERVERS.items():
+        os.mkdir(os.path.join(_tmp, name))
+        config = dict(config)
+
+        if config_file == 'fileserver.dfs.json':
+            os.makedirs(os.path.join(_tmp, name, config['fsroot'], 'data'))
+            config.update(nameserver=_addr('names'),
+                          lockserver=_addr('locks'), srv=_addr(name))
+
+        with open(os.path.join(_tmp, name, config_file), 'w') as f:
+            json.dump(config, f)
+
+    for name in ORDER:
+        _start(name)
+
+        if name == 'fs1':
+            # registered first
+            time.sleep(1)
+
+    for name in ('fs1', 'fs3'):
+        _wait_clean(name)
+
+    # the client reads its config in the working directory when imported
+    os.mkdir(os.path.join(_tmp, 'client'))
+
+    with open(os.path.join(_tmp, 'client', 'client.dfs.json'), 'w') as f:
+        json.dump({'nameserver': _addr('names'),
+                   'lockserver': _addr('locks')}, f)
+
+    os.chdir(os.path.join(_tmp, 'client'))
+    sys.path.insert(0, ROOT)
+    import dfs.client
+    import dfs.utils
+    c, utils = dfs.client, dfs.utils
+
+
+def tearDownModule():
+    # what the client does at exit, while the servers are still there
+    c._uploader.close()
+    c._keeper.close()
+
+    for name in list(_procs):
+        _kill(name)
+
+    os.chdir(ROOT)
+    shutil.rmtree(_tmp, True)
+
+
+@atexit.register
+def _cleanup():
+    # e.g. interrupted tests
+    for proc in _procs.values():
+        try:
+            os.kill(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+def _write(filepath, data):
+    with c.open(filepath, 'w') as f:
+        f.write(data)
+
+
+def _read(filepath):
+    with c.open(filepath) as f:
+        return f.read()
+
+
+class ReplicaTest(unittest.TestCase):
+    def tearDown(self):
+        for name in ('fs1', 'fs3'):
+            if name not in _procs:
+                _start(name)
+
+        for name in ('fs1', 'fs3'):
+            _wait_clean(name)
+
+    def test_write_replicated(self):
+        _write('/data/replicated', 'both')
+
+        self.assertEqual(_local('fs1', '/data/replicated'), 'both')
+        self.assertEqual(_local('fs3', '/data/replicated'), 'both')
+
+    def test_failover(self):
+        _write('/data/failover', 'v1')
+        _kill('fs1')
+
+        self.assertEqual(_read('/data/failover'), 'v1')
+        _write('/data/failover', 'v2')
+        self.assertEqual(_read('/data/failover'), 'v2')
+        self.assertEqual(_local('fs3', '/data/failover'), 'v2')
+
+    def test_resync(self):
+        _write('/data/changed', 'old')
+        _write('/data/removed', 'old')
+        _kill('fs3')
+
+        _write('/data/changed', 'new')
+        _write('/data/created', 'new')
+        host, port = utils.get_host_port(_addr('locks'))
+        lock_id = utils.get_lock('/data/removed', host, port)
+        c.unlink('/data/removed', lock_id)
+        utils.revoke_lock('/data/removed', host, port, lock_id)
+        self.assertEqual(_local('fs3', '/data/changed'), 'old')
+
+        _start('fs3')
+        # the old content is never served, the reads are refused until
+        # it's resynced
+        self.assertIn(_http('fs3', 'GET', '/data/changed'),
+                      ((200, 'new'), (503, '')))
+        _wait_clean('fs3')
+
+        self.assertEqual(_http('fs3', 'GET', '/data/changed'), (200, 'new'))
+        self.assertEqual(_http('fs3', 'GET', '/data/created'), (200, 'new'))
+        self.assertEqual(_local('fs3', '/data/removed'), None)
+
+    def test_etags(self):
+        _write('/data/etag', 'same')
+        etags = []
+
+        for name in ('fs1', 'fs3'):
+            con = httplib.HTTPConnection('localhost', _ports[name])
+            con.request('HEAD', '/data/etag')
+            etags.append(con.getresponse().getheader('ETag'))
+            con.close()
+
+        self.assertEqual(etags[0], etags[1])
+
+
+class AppendTest(unittest.TestCase):
+    def test_order(self):
+        records = ['%02d-%03d\n' % (t, n) for t in xrange(4)
+                   for n in xrange(25)]
+        errors = []
+
+        def append(t):
+            try:
+                for n in xrange(25):
+                    c.append('/data/log', '%02d-%03d\n' % (t, n))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=append, args=(t,))
+                   for t in xrange(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        content = _local('fs1', '/data/log')
+        # the same records in the same order on both replicas
+        self.assertEqual(content, _local('fs3', '/data/log'))
+        self.assertEqual(sorted(content.splitlines(True)), records)
+
+        for t in xrange(4):
+            # the records of a thread are in the order it appended them
+            mine = [line for line in content.splitlines()
+                    if line.startswith('%02d-' % t)]
+            self.assertEqual(mine, sorted(mine))
+
+    def test_offset(self):
+        first = c.append('/data/offsets', 'abc')
+        second = c.append('/data/offsets', 'defg')
+
+        self.assertEqual(second - first, 3)
+        self.assertEqual(_read('/data/offsets')[second:], 'defg')
+
+
+class LockTest(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = utils.get_host_port(_addr('locks'))
+
+    def test_lease_blocks_writers(self):
+        _write('/data/leased', 'read me')
+        reader = c.open('/data/leased', 'rl')
+
+        try:
+            self.assertRaises(utils.LockRefused, utils.get_lock,
+                              '/data/leased', self.host, self.port)
+            self.assertRaises(c.DFSIOError, c.open, '/data/leased', 'w')
+            # the readers share the file
+            self.assertEqual(_read('/data/leased'), 'read me')
+        finally:
+            reader.close()
+
+        lock_id = utils.get_lock('/data/leased', self.host, self.port)
+        utils.revoke_lock('/data/leased', self.host, self.port, lock_id)
+
+    def test_writer_waits_for_readers(self):
+        _write('/data/drained', 'x')
+        lease = utils.get_lock('/data/drained', self.host, self.port, True)
+        timer = threading.Timer(1, utils.revoke_lock,
+                                ('/data/drained', self.host, self.port,
+                                 lease))
+        timer.start()
+        start = time.time()
+        lock_id = utils.get_lock('/data/drained', self.host, self.port,
+                                 wait=5)
+        timer.join()
+
+        self.assertTrue(time.time() - start >= 0.5)
+        utils.revoke_lock('/data/drained', self.host, self.port, lock_id)
+
+    def test_lock_blocks_readers(self):
+        _write('/data/locked', 'x')
+        lock_id = utils.get_lock('/data/locked', self.host, self.port)
+
+        try:
+            self.assertRaises(c.DFSIOError, _read, '/data/locked')
+            self.assertEqual(_http('fs1', 'PUT', '/data/locked', 'y')[0],
+                             401)
+        finally:
+            utils.revoke_lock('/data/locked', self.host, self.port, lock_id)
+
+        self.assertEqual(_read('/data/locked'), 'x')
+
+    def test_idle_kept_lock(self):
+        with c.open('/data/kept', 'wc') as f:
+            f.write('mine')
+
+        # the client keeps the lock, but it's idle: another one gets it
+        lock_id = utils.get_lock('/data/kept', self.host, self.port)
+        utils.revoke_lock('/data/kept', self.host, self.port, lock_id)
+
+        with c.open('/data/kept', 'ac') as f:
+            f.write(' again')
+
+        self.assertEqual(_read('/data/kept'), 'mine again')
+
+
+class WriteAheadLogTest(unittest.TestCase):
+    def setUp(self):
+        self.host, self.port = utils.get_host_port(_addr('locks'))
+
+    def tearDown(self):
+        if 'locks' not in _procs:
+            _start('locks')
+
+    def _restart(self):
+        _kill('locks', signal.SIGKILL)
+        _start('locks')
+
+    def test_replay(self):
+        kept = utils.get_lock('/data/wal-kept', self.host, self.port)
+        revoked = utils.get_lock('/data/wal-revoked', self.host, self.port)
+        utils.revoke_lock('/data/wal-revoked', self.host, self.port, revoked)
+        self._restart()
+
+        self.assertTrue(utils.is_locked('/data/wal-kept', self.host,
+                                        self.port))
+        self.assertFalse(utils.is_locked('/data/wal-kept', self.host,
+                                         self.port, kept))
+        self.assertFalse(utils.is_locked('/data/wal-revoked', self.host,
+                                         self.port))
+        utils.revoke_lock('/data/wal-kept', self.host, self.port, kept)
+
+    def test_leases_not_replayed(self):
+        utils.get_lock('/data/wal-lease', self.host, self.port, True)
+        self._restart()
+
+        self.assertFalse(utils.is_locked('/data/wal-lease', self.host,
+                                         self.port, write=True))
+
+
+if __name__ == '__main__':
+    unittest.main()